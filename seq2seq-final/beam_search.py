@@ -0,0 +1,72 @@
+import torch
+
+# Beam search shared by the seq2seq and Transformer models. The beams are folded into the batch dimension, so
+# every step is a single forward pass over batch_size * beam_size rows.
+#
+# The model is driven through two functions:
+#   step(input, state) -> (log_probs, state), with input of shape (batch_size * beam_size, 1) holding the last
+#       token of every beam, and log_probs of shape (batch_size * beam_size, vocab_size)
+#   reorder(state, index) -> state, selecting the rows of the state given by index (which may repeat rows). It is
+#       also used to expand the initial state from batch_size to batch_size * beam_size rows. Leave it as None if
+#       the state does not depend on the beam (e.g. it only depends on the source sentence).
+
+def length_penalty(lengths, alpha = 0.6):
+    # From Wu et al. (2016), https://arxiv.org/abs/1609.08144
+    return ((5 + lengths.float()) / 6) ** alpha
+
+def beam_search(step, state, batch_size, device, beam_size = 4, max_len = 50, reorder = None, alpha = 0.6, n_best = 1, SOS_token = 0, EOS_token = 1):
+    n_best = min(n_best, beam_size)
+
+    # Row b * beam_size + k holds beam k of sentence b
+    if reorder is not None:
+        state = reorder(state, torch.arange(batch_size, device = device).repeat_interleave(beam_size))
+    beam_offset = (torch.arange(batch_size, device = device) * beam_size).unsqueeze(1)
+
+    decoder_input = torch.full((batch_size * beam_size, 1), SOS_token, dtype = torch.long, device = device)
+
+    # Only the first beam is alive at the start, otherwise every beam would pick the same first token
+    scores = torch.full((batch_size, beam_size), float("-inf"), device = device)
+    scores[:, 0] = 0
+    lengths = torch.zeros(batch_size, beam_size, dtype = torch.long, device = device)
+    finished = torch.zeros(batch_size, beam_size, dtype = torch.bool, device = device)
+    hypotheses = torch.zeros(batch_size, beam_size, 0, dtype = torch.long, device = device)
+
+    for i in range(max_len):
+        log_probs, state = step(decoder_input, state)
+        vocab_size = log_probs.size(-1)
+        log_probs = log_probs.float().view(batch_size, beam_size, vocab_size)
+
+        # Finished beams are carried over unchanged, with padding as their only continuation
+        padding = torch.full((vocab_size,), float("-inf"), device = device)
+        padding[SOS_token] = 0
+        log_probs = torch.where(finished.unsqueeze(-1), padding, log_probs)
+
+        candidate_scores = scores.unsqueeze(-1) + log_probs  # batch_size x beam_size x vocab_size
+        candidate_lengths = lengths + (~finished).long()  # batch_size x beam_size
+
+        # Rank candidates by their length-normalised score, so finished and unfinished beams compete fairly
+        normalised = candidate_scores / length_penalty(candidate_lengths, alpha).unsqueeze(-1)
+        _, top_indices = normalised.view(batch_size, -1).topk(beam_size, dim = -1)
+        beam_indices = top_indices // vocab_size
+        token_indices = top_indices % vocab_size
+
+        scores = candidate_scores.view(batch_size, -1).gather(1, top_indices)
+        lengths = candidate_lengths.gather(1, beam_indices)
+        finished = finished.gather(1, beam_indices) | (token_indices == EOS_token)
+        hypotheses = torch.cat([hypotheses.gather(1, beam_indices.unsqueeze(-1).expand(-1, -1, hypotheses.size(-1))), token_indices.unsqueeze(-1)], dim = -1)
+
+        # Stop once every beam of every sentence has produced EOS
+        if finished.all():
+            break
+
+        if reorder is not None:
+            state = reorder(state, (beam_indices + beam_offset).view(-1))
+        decoder_input = token_indices.view(-1, 1)
+
+    # Sort the beams of each sentence by their final normalised score and keep the n best
+    final_scores = scores / length_penalty(lengths, alpha)
+    final_scores, order = final_scores.sort(dim = -1, descending = True)
+    order = order[:, :n_best]
+    hypotheses = hypotheses.gather(1, order.unsqueeze(-1).expand(-1, -1, hypotheses.size(-1)))
+
+    return hypotheses, final_scores[:, :n_best]  # batch_size x n_best x steps, batch_size x n_best
\ No newline at end of file
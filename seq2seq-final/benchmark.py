@@ -0,0 +1,660 @@
+import os
+import time
+import pickle
+import tracemalloc
+import resource
+import tempfile
+import torch
+import argparse
+import torch.nn as nn
+from torch import optim
+
+import numpy as np
+import random
+
+from dataset import Lang, TranslationDataset, StreamingTranslationDataset, BucketBatchSampler, collate_batch, collate_padded, read_normalized_pairs
+from models import EncoderRNN, DecoderRNN
+
+from torch.utils.data import DataLoader, Subset, random_split, default_collate
+
+from utils import read_settings, calculate_bleu, calculate_nist, CorpusMetrics, make_metrics, autocast, grad_scaler
+from nltk.translate.bleu_score import corpus_bleu, SmoothingFunction
+from nltk.translate.nist_score import corpus_nist
+
+device = torch.device("cpu")
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = "Benchmark the seq2seq model with the settings from a YAML file.")
+    parser.add_argument("--config", type = str, default = "config.yaml", help = "Path to YAML configuration file")
+    parser.add_argument("--benchmark", type = str, default = "early_exit", choices = ["early_exit", "train_step", "batching", "dataset", "normalization", "streaming", "collation", "loading", "vocab", "pruning", "bpe", "metrics", "metric_cadence", "precision", "accumulation"], help = "Benchmark to run")
+    parser.add_argument("--directory", type = str, default = "../fr-en/", help = "Directory containing the Europarl files")
+    parser.add_argument("--num_batches", type = int, default = 50, help = "Number of batches to time")
+    parser.add_argument("--vocab_size", type = int, default = 10000, help = "Source and target vocabulary size of the random model (train_step only)")
+    parser.add_argument("--repeats", type = int, default = 3, help = "Number of timed runs per setting (pruning only)")
+    return parser.parse_args()
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def benchmark_early_exit(val_dataloader, encoder, decoder, num_batches):
+    # Greedy decoding of the validation split: full max_seq_len unrolling against early exit (with and without compaction)
+    batches = []
+    for i, (input_sentence, input_tensor, target_tensor) in enumerate(val_dataloader):
+        if i == num_batches:
+            break
+        batches.append(input_tensor.to(device))
+    n_sentences = sum(len(input_tensor) for input_tensor in batches)
+
+    def full(encoder_outputs, encoder_hidden):
+        decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, None)
+        return decoder_outputs.argmax(-1)
+
+    methods = {
+        "full": full,
+        "early_exit": lambda encoder_outputs, encoder_hidden: decoder.generate(encoder_outputs, encoder_hidden),
+        "compact": lambda encoder_outputs, encoder_hidden: decoder.generate(encoder_outputs, encoder_hidden, compact = True),
+    }
+
+    print(f"{'method':>12} {'sentences/s':>12} {'speedup':>9} {'mean steps':>11}")
+
+    with torch.no_grad():
+        encoded = [encoder(input_tensor, lengths = (input_tensor != 0).sum(dim = 1)) for input_tensor in batches]
+
+        baseline = None
+        for name, method in methods.items():
+            method(*encoded[0])
+            synchronize()
+            start = time.perf_counter()
+            steps = [method(encoder_outputs, encoder_hidden).size(1) for encoder_outputs, encoder_hidden in encoded]
+            synchronize()
+            elapsed = time.perf_counter() - start
+
+            if baseline is None:
+                baseline = elapsed
+            print(f"{name:>12} {n_sentences / elapsed:>12.1f} {baseline / elapsed:>8.2f}x {np.mean(steps):>11.1f}")
+
+def make_train_step(encoder, decoder, precision = "fp32"):
+    # A single optimisation step, as in train_epoch of train.py
+    encoder.train()
+    decoder.train()
+    encoder_optimizer = optim.Adam(encoder.parameters())
+    decoder_optimizer = optim.Adam(decoder.parameters())
+    criterion = nn.CrossEntropyLoss()
+    scaler = grad_scaler(precision)
+
+    def train_step(input_tensor, target_tensor, teacher_forcing_ratio = 1, metrics = None):
+        encoder_optimizer.zero_grad()
+        decoder_optimizer.zero_grad()
+        with autocast(precision):
+            encoder_outputs, encoder_hidden = encoder(input_tensor, lengths = (input_tensor != 0).sum(dim = 1))
+            decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, target_tensor, teacher_forcing_ratio = teacher_forcing_ratio)
+            loss = criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
+        scaler.scale(loss).backward()
+        scaler.step(encoder_optimizer)
+        scaler.step(decoder_optimizer)
+        scaler.update()
+        if metrics is not None:
+            metrics.update(decoder_outputs.detach(), target_tensor)
+        return loss.item()
+
+    return train_step
+
+def benchmark_train_step(encoder, decoder, batch_size, seq_len, vocab_size, num_batches):
+    # Training step time with scheduled sampling (step-by-step decoder loop) against full teacher forcing (one GRU/LSTM call)
+    train_step = make_train_step(encoder, decoder)
+
+    input_tensor = torch.randint(2, vocab_size, (batch_size, seq_len), device = device)
+    target_tensor = torch.randint(2, vocab_size, (batch_size, seq_len), device = device)
+
+    print(f"{'teacher forcing':>16} {'ms/step':>9} {'speedup':>9}")
+
+    baseline = None
+    for teacher_forcing_ratio in [0.5, 1]:
+        train_step(input_tensor, target_tensor, teacher_forcing_ratio)
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            train_step(input_tensor, target_tensor, teacher_forcing_ratio)
+        synchronize()
+        elapsed = (time.perf_counter() - start) / num_batches
+
+        if baseline is None:
+            baseline = elapsed
+        print(f"{teacher_forcing_ratio:>16} {elapsed * 1000:>9.2f} {baseline / elapsed:>8.2f}x")
+
+def benchmark_batching(train_dataset, lengths, encoder, decoder, train_settings, num_batches, generator):
+    # Training throughput in real (non-padding) source and target tokens per second, fixed padding against length bucketing
+    train_step = make_train_step(encoder, decoder)
+    max_tokens = train_settings["max_tokens"] if isinstance(train_settings["max_tokens"], int) else None
+
+    dataloaders = {
+        "fixed": DataLoader(train_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded),
+        "bucketed": DataLoader(train_dataset, batch_sampler = BucketBatchSampler(lengths, batch_size = train_settings["batch_size"], max_tokens = max_tokens, generator = generator), collate_fn = collate_batch),
+    }
+
+    print(f"{'batching':>10} {'tokens/s':>10} {'speedup':>9} {'padding':>9}")
+
+    baseline = None
+    for name, dataloader in dataloaders.items():
+        n_tokens = 0
+        n_padded = 0
+        synchronize()
+        start = time.perf_counter()
+        for i, (input_sentence, input_tensor, target_tensor) in enumerate(dataloader):
+            if i == num_batches:
+                break
+            input_tensor, target_tensor = input_tensor.to(device, non_blocking = True), target_tensor.to(device, non_blocking = True)
+            train_step(input_tensor, target_tensor)
+            n_tokens += (input_tensor != 0).sum().item() + (target_tensor != 0).sum().item()
+            n_padded += input_tensor.numel() + target_tensor.numel()
+        synchronize()
+        tokens_per_second = n_tokens / (time.perf_counter() - start)
+
+        if baseline is None:
+            baseline = tokens_per_second
+        print(f"{name:>10} {tokens_per_second:>10.1f} {tokens_per_second / baseline:>8.2f}x {1 - n_tokens / n_padded:>9.1%}")
+
+    # A batch is pickled whenever it comes from a DataLoader worker, so it should hold the batch only (the tensors and
+    # the input sentences), and never a copy of the corpus or the vocabularies
+    batch = train_dataset.__getitems__(list(range(min(train_settings["batch_size"], len(train_dataset)))))
+    batch_bytes = sum(tensor.numel() * tensor.element_size() for tensor in batch[1:]) + sum(len(sentence.encode("utf-8")) for sentence in batch[0])
+    pickled_bytes = len(pickle.dumps(batch))
+    print(f"pickled batch of {len(batch[1])} pairs: {pickled_bytes / 1024:.1f} KB for {batch_bytes / 1024:.1f} KB of tensors and sentences, small: {pickled_bytes < 2 * batch_bytes + 4096}")
+
+def benchmark_loading(train_datasets, train_step, train_settings, num_batches):
+    # Training steps per second and share of each step spent waiting on data, with batches built in the training
+    # process against batches built by worker processes (pinned and prefetched), for the same pairs read from the text
+    # files and from the token cache. Worker batches are pickled to the training process, so the pickled size of a
+    # batch is reported as well (it should be about the same for both datasets)
+    num_workers = max(train_settings["num_workers"], 2)
+    loader_settings = {
+        "in-process": {"num_workers": 0},
+        f"{num_workers} workers": {"num_workers": num_workers, "pin_memory": torch.cuda.is_available(), "prefetch_factor": train_settings["prefetch_factor"]},
+    }
+
+    print(f"{'dataset':>8} {'loading':>12} {'steps/s':>9} {'data wait':>10} {'batch KB':>9}")
+
+    for dataset_name, train_dataset in train_datasets.items():
+        batch = collate_padded(train_dataset.__getitems__(list(range(train_settings["batch_size"]))))
+        batch_kb = len(pickle.dumps(batch)) / 1024
+
+        for name, settings in loader_settings.items():
+            dataloader = DataLoader(train_dataset, batch_size = train_settings["batch_size"], shuffle = True, collate_fn = collate_padded, **settings)
+            data_time = 0
+            synchronize()
+            start = time.perf_counter()
+            data_start = start
+            for i, (_, input_tensor, target_tensor) in enumerate(dataloader):
+                if i == num_batches:
+                    break
+                data_time += time.perf_counter() - data_start
+                train_step(input_tensor.to(device, non_blocking = True), target_tensor.to(device, non_blocking = True))
+                data_start = time.perf_counter()
+            synchronize()
+            elapsed = time.perf_counter() - start
+            print(f"{dataset_name:>8} {name:>12} {num_batches / elapsed:>9.2f} {data_time / elapsed:>10.1%} {batch_kb:>9.1f}")
+
+def benchmark_normalization(directory):
+    # Text normalisation throughput against the number of worker processes
+    path1, path2 = f"{directory}europarl-v7.fr-en.en", f"{directory}europarl-v7.fr-en.fr"
+    print(f"{'workers':>8} {'lines/s':>10} {'speedup':>9}")
+
+    baseline = None
+    for num_workers in sorted({1, 2, 4, os.cpu_count()}):
+        start = time.perf_counter()
+        n_lines = sum(1 for _ in read_normalized_pairs(path1, path2, num_workers = num_workers))
+        lines_per_second = n_lines / (time.perf_counter() - start)
+
+        if baseline is None:
+            baseline = lines_per_second
+        print(f"{num_workers:>8} {lines_per_second:>10.1f} {lines_per_second / baseline:>8.2f}x")
+
+def benchmark_streaming(directory, max_seq_len, batch_size, shuffle_buffer):
+    # One pass over the training pairs with the streaming dataset and with the in-memory dataset, in pairs per second
+    # and growth of the peak resident memory. Peak memory only goes up, so the streaming dataset is measured first.
+    print(f"{'dataset':>10} {'pairs/s':>10} {'peak RSS growth (MB)':>21}")
+
+    datasets = {
+        "streaming": lambda: StreamingTranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = max_seq_len, reverse = False, directory = directory, shuffle_buffer = shuffle_buffer).subset("train"),
+        "in-memory": lambda: TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = max_seq_len, reverse = False, directory = directory),
+    }
+
+    for name, make_dataset in datasets.items():
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        n_pairs = sum(len(input_sentences) for input_sentences, _, _ in DataLoader(make_dataset(), batch_size = batch_size, collate_fn = collate_padded))
+        pairs_per_second = n_pairs / (time.perf_counter() - start)
+        print(f"{name:>10} {pairs_per_second:>10.1f} {(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss) / 1024:>21.1f}")
+
+def benchmark_collation(dataset, batch_size, num_batches):
+    # Batches per second of one __getitem__ per pair plus the default collate against the vectorized __getitems__
+    batches = [indices.tolist() for indices in torch.randperm(len(dataset))[:batch_size * num_batches].split(batch_size)]
+    methods = {
+        "per-sample": lambda indices: default_collate([dataset[i] for i in indices]),
+        "batched": lambda indices: collate_padded(dataset.__getitems__(indices)),
+    }
+
+    print(f"{'method':>12} {'batches/s':>10} {'speedup':>9}")
+
+    baseline = None
+    for name, method in methods.items():
+        start = time.perf_counter()
+        for indices in batches:
+            method(indices)
+        batches_per_second = len(batches) / (time.perf_counter() - start)
+
+        if baseline is None:
+            baseline = batches_per_second
+        print(f"{name:>12} {batches_per_second:>10.1f} {batches_per_second / baseline:>8.2f}x")
+
+def benchmark_vocab(lang):
+    # Pickled size, memory after loading and load time of a vocabulary (as stored in seq2seq checkpoints), for the
+    # three dictionaries of the previous Lang against the compact Lang, pickled and memory-mapped from its own files
+    dicts = {"name": lang.name, "word2index": dict(lang.word2index), "word2count": dict(lang.word2count.items()),
+             "index2word": {index: lang.index2word[index] for index in range(lang.n_words)}, "n_words": lang.n_words}
+
+    print(f"{'vocabulary':>10} {'size (MB)':>10} {'memory (MB)':>12} {'load ms':>9}")
+
+    with tempfile.TemporaryDirectory() as path:
+        lang.save(path)
+        loaders = {
+            "dicts": (len(pickle.dumps(dicts)), lambda data = pickle.dumps(dicts): pickle.loads(data)),
+            "compact": (len(pickle.dumps(lang)), lambda data = pickle.dumps(lang): pickle.loads(data)),
+            "mmap": (sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)), lambda: Lang.load(path)),
+        }
+
+        for name, (size, load) in loaders.items():
+            start = time.perf_counter()
+            load()
+            elapsed = time.perf_counter() - start
+
+            # Memory is measured on a separate load, as tracing slows allocations down
+            tracemalloc.start()
+            loaded = load()
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del loaded
+
+            print(f"{name:>10} {size / 2 ** 20:>10.2f} {memory / 2 ** 20:>12.2f} {elapsed * 1000:>9.2f}")
+
+def benchmark_pruning(lang, hidden_size, num_tokens, repeats = 3, min_counts = [1, 2, 5, 10, 20, 50]):
+    # Size and cost of the output layer (hidden_size -> vocabulary Linear, followed by the softmax) for the vocabulary
+    # pruned at each min_count, against the share of target tokens that become UNK. FLOPs are for the forward pass of
+    # the Linear over num_tokens tokens (one padded batch), the time is for the forward and backward pass of the Linear
+    # and the cross-entropy.
+    total = sum(count for _, count in lang.word2count.items())
+    print(f"{'min count':>9} {'words':>7} {'UNK %':>7} {'params (M)':>11} {'memory (MB)':>12} {'GFLOPs':>8} {'ms':>8}")
+
+    for min_count in min_counts:
+        pruned_lang = lang.prune(min_count)[0] if min_count > 1 else lang
+        vocab_size = pruned_lang.n_words
+        unk = 0 if pruned_lang.unk_index is None else int(pruned_lang.counts[pruned_lang.unk_index])
+
+        output_layer = nn.Linear(hidden_size, vocab_size).to(device)
+        params = sum(p.numel() for p in output_layer.parameters())
+        hidden = torch.randn(num_tokens, hidden_size, device = device, requires_grad = True)
+        target = torch.randint(vocab_size, (num_tokens,), device = device)
+
+        times = []
+        for _ in range(repeats + 1):
+            synchronize()
+            start = time.perf_counter()
+            nn.functional.cross_entropy(output_layer(hidden), target).backward()
+            synchronize()
+            times.append(time.perf_counter() - start)
+        elapsed = min(times[1:])  # The first run is a warm-up
+
+        print(f"{min_count:>9} {vocab_size:>7} {100 * unk / total:>7.2f} {params / 1e6:>11.2f} {params * 4 / 2 ** 20:>12.2f} {2 * num_tokens * hidden_size * vocab_size / 1e9:>8.2f} {elapsed * 1000:>8.1f}")
+
+def benchmark_bpe(directory, num_merges, batch_size = 1000):
+    # Time to learn the BPE merges from the English side of the corpus, the vocabulary and sentence lengths against
+    # words, and the encoding speed with the word cache cleared for every sentence, with the cache, and in batches.
+    # Batched encoding is checked against encoding one sentence at a time, with an empty and a punctuation-only
+    # sentence added (as lines like "1." normalise to "")
+    sentences = [pair[0] for pair in read_normalized_pairs(f"{directory}europarl-v7.fr-en.en", f"{directory}europarl-v7.fr-en.fr")]
+    lang = Lang("europarl-v7.fr-en.en")
+    for sentence in sentences:
+        lang.addSentence(sentence)
+
+    start = time.perf_counter()
+    subword_lang = lang.learn_subwords(num_merges)
+    elapsed = time.perf_counter() - start
+    bpe = subword_lang.tokenizer
+    n_words = sum(count for _, count in lang.word2count.items())
+    n_subwords = sum(count for _, count in subword_lang.word2count.items())
+    print(f"Learnt {len(bpe.merges)} merges in {elapsed:.2f} s")
+    print(f"{lang.n_words} words -> {subword_lang.n_words} subwords, {n_words / len(sentences):.1f} -> {n_subwords / len(sentences):.1f} tokens per sentence")
+
+    def uncached():
+        for sentence in sentences:
+            bpe.cache.clear()
+            bpe.encode(sentence)
+
+    def cached():
+        for sentence in sentences:
+            bpe.encode(sentence)
+
+    def batched():
+        for start in range(0, len(sentences), batch_size):
+            bpe.encode_batch(sentences[start:start + batch_size])
+
+    print(f"{'encoder':>9} {'sentences/s':>12} {'speedup':>9}")
+    baseline = None
+    for name, encode in [("uncached", uncached), ("cached", cached), ("batched", batched)]:
+        bpe.cache.clear()
+        start = time.perf_counter()
+        encode()
+        sentences_per_second = len(sentences) / (time.perf_counter() - start)
+
+        if baseline is None:
+            baseline = sentences_per_second
+        print(f"{name:>9} {sentences_per_second:>12.0f} {sentences_per_second / baseline:>8.2f}x")
+
+    check = sentences[:batch_size] + ["", "?"]
+    bpe.cache.clear()
+    batched_subwords = bpe.encode_batch(check)
+    bpe.cache.clear()
+    print(f"Batched encoding identical: {batched_subwords == [bpe.encode(sentence) for sentence in check]}")
+
+def benchmark_metrics(batch_size, seq_len, vocab_size, num_batches):
+    # Time per batch of the per-sentence NLTK calculate_bleu and calculate_nist against CorpusMetrics, for predictions
+    # that copy random targets with 30% of their tokens replaced, and the corpus scores against NLTK's own
+    batches = []
+    positions = torch.arange(seq_len)
+    for _ in range(num_batches):
+        lengths = torch.randint(seq_len // 4, seq_len, (batch_size, 1))
+        target = torch.randint(2, vocab_size, (batch_size, seq_len))
+        target[positions == lengths] = 1
+        target[positions > lengths] = 0
+        predicted = torch.where(torch.rand(batch_size, seq_len) < 0.3, torch.randint(2, vocab_size, (batch_size, seq_len)), target)
+        batches.append((predicted.to(device), target.to(device)))
+
+    def scores(predicted):
+        # The training loop scores the decoder outputs, so the predicted ids are turned into one-hot scores
+        return torch.zeros(*predicted.shape, vocab_size, device = device).scatter_(-1, predicted.unsqueeze(-1), 1)
+
+    # The argmax over the scores is the same for both, and is also reported on its own
+    elapsed = 0
+    for predicted, target in batches:
+        decoder_outputs = scores(predicted)
+        synchronize()
+        start = time.perf_counter()
+        decoder_outputs.argmax(dim = -1)
+        synchronize()
+        elapsed += time.perf_counter() - start
+    argmax_ms = elapsed * 1000 / num_batches
+
+    elapsed = 0
+    for predicted, target in batches:
+        decoder_outputs = scores(predicted)
+        synchronize()
+        start = time.perf_counter()
+        calculate_bleu(decoder_outputs, target)
+        calculate_nist(decoder_outputs, target)
+        elapsed += time.perf_counter() - start
+    nltk_ms = elapsed * 1000 / num_batches
+
+    metrics = CorpusMetrics()
+    elapsed = 0
+    for predicted, target in batches:
+        decoder_outputs = scores(predicted)
+        synchronize()
+        start = time.perf_counter()
+        metrics.update(decoder_outputs, target)
+        synchronize()
+        elapsed += time.perf_counter() - start
+    start = time.perf_counter()
+    bleu, nist = metrics.bleu(), metrics.nist()
+    elapsed += time.perf_counter() - start
+    corpus_ms = elapsed * 1000 / num_batches
+
+    def cut(tokens):
+        return tokens[:tokens.index(1)] if 1 in tokens else tokens
+    references = [[cut(tokens)] for _, target in batches for tokens in target.tolist()]
+    hypotheses = [cut(tokens) for predicted, _ in batches for tokens in predicted.tolist()]
+
+    print(f"{'metrics':>16} {'ms/batch':>9} {'speedup':>9} {'without argmax':>15}")
+    print(f"{'argmax':>16} {argmax_ms:>9.2f}")
+    print(f"{'NLTK sentence':>16} {nltk_ms:>9.2f} {1:>8.2f}x {1:>14.2f}x")
+    print(f"{'CorpusMetrics':>16} {corpus_ms:>9.2f} {nltk_ms / corpus_ms:>8.2f}x {(nltk_ms - argmax_ms) / max(corpus_ms - argmax_ms, 1e-6):>14.2f}x")
+    print(f"Corpus BLEU {bleu:.6f} (NLTK {corpus_bleu(references, hypotheses, smoothing_function = SmoothingFunction().method1):.6f}), NIST {nist:.6f} (NLTK {corpus_nist(references, hypotheses, 4):.6f})")
+
+def random_batches(batch_size, seq_len, vocab_size, num_batches, copy = False):
+    # Random sentences of varying lengths, ended by EOS and padded with zeros as in the dataset. With copy = True the
+    # target is the source sentence, which gives the models something to learn
+    batches = []
+    positions = torch.arange(seq_len)
+    for _ in range(num_batches):
+        lengths = torch.randint(seq_len // 4, seq_len, (batch_size, 1))
+        src = torch.randint(2, vocab_size, (batch_size, seq_len))
+        target = src.clone() if copy == True else torch.randint(2, vocab_size, (batch_size, seq_len))
+        for tensor in [src, target]:
+            tensor[positions == lengths] = 1
+            tensor[positions > lengths] = 0
+        batches.append((src.to(device), target.to(device)))
+    return batches
+
+def benchmark_metric_cadence(train_step, batch_size, seq_len, vocab_size, num_batches):
+    # Training steps per second without training metrics, with BLEU/NIST on every batch, on every 10th batch and in a
+    # background thread, and the time bleu() and nist() then take at the end of the epoch
+    batches = random_batches(batch_size, seq_len, vocab_size, num_batches)
+    print(f"{'metrics':>10} {'steps/s':>9} {'speedup':>9} {'end ms':>8}")
+    baseline = None
+    for name, metric_every, async_metrics in [("none", None, False), ("every", 1, False), ("every 10", 10, False), ("async", 1, True)]:
+        metrics = None if metric_every is None else make_metrics(async_metrics)
+        train_step(*batches[0])
+        synchronize()
+
+        start = time.perf_counter()
+        for batch_index, (src, target) in enumerate(batches):
+            train_step(src, target, metrics = metrics if metric_every is not None and batch_index % metric_every == 0 else None)
+        synchronize()
+        steps_per_second = num_batches / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        if metrics is not None:
+            metrics.bleu()
+            metrics.nist()
+        end_ms = (time.perf_counter() - start) * 1000
+
+        if baseline is None:
+            baseline = steps_per_second
+        print(f"{name:>10} {steps_per_second:>9.2f} {steps_per_second / baseline:>8.2f}x {end_ms:>8.1f}")
+
+def benchmark_precision(make_train_step, batches, epochs = 5):
+    # Step time and mean loss per epoch of the same model trained in fp32, bf16 and fp16 on a copy task. As a sanity
+    # check of convergence, the reduced-precision losses should fall like the fp32 loss (a NaN or diverging loss means
+    # the precision is not numerically safe for the model)
+    print(f"{'precision':>10} {'ms/step':>9} {'speedup':>9}  loss per epoch")
+    baseline = None
+    for precision in ["fp32", "bf16", "fp16"]:
+        # Same initial weights for every precision
+        torch.manual_seed(0)
+        train_step = make_train_step(precision)
+        try:
+            train_step(*batches[0])
+        except RuntimeError as error:
+            # e.g. float16 LSTMs on the CPU
+            print(f"{precision:>10} not supported on {device.type}: {str(error).splitlines()[0]}")
+            continue
+        synchronize()
+
+        losses = []
+        start = time.perf_counter()
+        for _ in range(epochs):
+            losses.append(sum(train_step(src, target) for src, target in batches) / len(batches))
+        synchronize()
+        step_ms = (time.perf_counter() - start) * 1000 / (epochs * len(batches))
+
+        if baseline is None:
+            baseline = step_ms
+        print(f"{precision:>10} {step_ms:>9.2f} {baseline / step_ms:>8.2f}x  " + " ".join(f"{loss:.4f}" for loss in losses))
+
+def benchmark_accumulation(parameters, compute_loss, ignore_index, src, target, repeats, accumulation_steps = [1, 2, 4, 8]):
+    # Gradients of one batch computed whole and accumulated over 2, 4 and 8 micro-batches, with each micro-batch loss
+    # weighted by its share of the target tokens as in train_epoch. The accumulated gradients should match the
+    # full-batch ones up to rounding, at a fraction of the activation memory
+    parameters = [p for p in parameters if p.requires_grad]
+
+    def gradients(steps):
+        for p in parameters:
+            p.grad = None
+        tokens = [(micro_target != ignore_index).sum().item() for micro_target in target.chunk(steps)]
+        for micro_src, micro_target, micro_tokens in zip(src.chunk(steps), target.chunk(steps), tokens):
+            (compute_loss(micro_src, micro_target) * (micro_tokens / sum(tokens))).backward()
+        return torch.cat([p.grad.flatten() for p in parameters if p.grad is not None])
+
+    full = gradients(1)
+    print(f"{'micro-batches':>14} {'micro-batch':>12} {'ms/step':>9} {'max grad diff':>14}")
+    for steps in accumulation_steps:
+        difference = (gradients(steps) - full).abs().max().item()
+        timings = []
+        for _ in range(repeats):
+            synchronize()
+            start = time.perf_counter()
+            gradients(steps)
+            synchronize()
+            timings.append(time.perf_counter() - start)
+        step_ms = min(timings) * 1000
+        print(f"{steps:>14} {len(src.chunk(steps)[0]):>12} {step_ms:>9.2f} {difference:>14.2e}")
+
+def benchmark_dataset(directory, max_seq_len, num_workers = 1):
+    # Dataset construction from the text files against building and then loading the memory-mapped token cache
+    print(f"{'source':>12} {'seconds':>9} {'speedup':>9}")
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        baseline = None
+        for name, dataset_cache in [("text", None), ("cache build", cache_dir), ("cache load", cache_dir)]:
+            start = time.perf_counter()
+            TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = max_seq_len, reverse = False, directory = directory, cache_dir = dataset_cache, num_workers = num_workers)
+            elapsed = time.perf_counter() - start
+
+            if baseline is None:
+                baseline = elapsed
+            print(f"{name:>12} {elapsed:>9.2f} {baseline / elapsed:>8.2f}x")
+
+def build_models(model_settings, input_size, output_size):
+    encoder = EncoderRNN(input_size, model_settings["hidden_dim"], bidirectional = model_settings["encoder_bidirect"], num_layers = model_settings["num_layers_encoder"], layer_norm = model_settings["layer_norm"]).to(device)
+    decoder = DecoderRNN(model_settings["hidden_dim"], output_size, num_layers = model_settings["num_layers_decoder"], use_lstm = model_settings["use_lstm_decoder"], max_seq_len = model_settings["max_seq_length"]).to(device)
+    return encoder, decoder
+
+def main():
+    # Same seed and split as train.py, so the validation split matches
+    randomer = 50
+    torch.manual_seed(randomer)
+    torch.cuda.manual_seed_all(randomer)
+    random.seed(randomer)
+    np.random.seed(randomer)
+
+    generator = torch.Generator().manual_seed(randomer)
+
+    args = parse_arguments()
+    settings = read_settings(args.config)
+    model_settings = settings.get("Model", {})
+    train_settings = settings.get("Train", {})
+    checkpoint_settings = settings.get("Checkpoint", {})
+
+    if args.benchmark == "accumulation":
+        encoder, decoder = build_models(model_settings, args.vocab_size, args.vocab_size)
+        # Without dropout, so every gradient computation is the same
+        encoder.eval()
+        decoder.eval()
+        criterion = nn.CrossEntropyLoss()
+        def compute_loss(input_tensor, target_tensor):
+            encoder_outputs, encoder_hidden = encoder(input_tensor, lengths = (input_tensor != 0).sum(dim = 1))
+            decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, target_tensor, teacher_forcing_ratio = 1)
+            return criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
+        src, target = random_batches(train_settings["batch_size"], model_settings["max_seq_length"], args.vocab_size, 1)[0]
+        benchmark_accumulation(list(encoder.parameters()) + list(decoder.parameters()), compute_loss, criterion.ignore_index, src, target, args.repeats)
+        return
+
+    if args.benchmark == "precision":
+        batches = random_batches(train_settings["batch_size"], model_settings["max_seq_length"], args.vocab_size, args.num_batches, copy = True)
+        benchmark_precision(lambda precision: make_train_step(*build_models(model_settings, args.vocab_size, args.vocab_size), precision = precision), batches)
+        return
+
+    if args.benchmark == "metric_cadence":
+        encoder, decoder = build_models(model_settings, args.vocab_size, args.vocab_size)
+        benchmark_metric_cadence(make_train_step(encoder, decoder), train_settings["batch_size"], model_settings["max_seq_length"], args.vocab_size, args.num_batches)
+        return
+
+    if args.benchmark == "train_step":
+        encoder, decoder = build_models(model_settings, args.vocab_size, args.vocab_size)
+        benchmark_train_step(encoder, decoder, train_settings["batch_size"], model_settings["max_seq_length"], args.vocab_size, args.num_batches)
+        return
+
+    if args.benchmark == "dataset":
+        benchmark_dataset(args.directory, model_settings["max_seq_length"], train_settings["preprocessing_workers"])
+        return
+
+    if args.benchmark == "normalization":
+        benchmark_normalization(args.directory)
+        return
+
+    if args.benchmark == "metrics":
+        benchmark_metrics(train_settings["batch_size"], model_settings["max_seq_length"], args.vocab_size, args.num_batches)
+        return
+
+    if args.benchmark == "bpe":
+        benchmark_bpe(args.directory, train_settings["bpe_merges"])
+        return
+
+    if args.benchmark == "streaming":
+        benchmark_streaming(args.directory, model_settings["max_seq_length"], train_settings["batch_size"], train_settings["shuffle_buffer"])
+        return
+
+    cache_dir = None if train_settings["dataset_cache"].lower() == "none" else train_settings["dataset_cache"]
+    dataset = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = args.directory, cache_dir = cache_dir, num_workers = train_settings["preprocessing_workers"], min_count = train_settings["min_word_count"], max_vocab_size = train_settings["max_vocab_size"] if isinstance(train_settings["max_vocab_size"], int) else None, tokenizer = train_settings["tokenizer"], bpe_merges = train_settings["bpe_merges"])
+
+    train_size = int(0.8 * len(dataset))
+    val_size = len(dataset) - train_size
+    train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator = generator)
+    val_dataloader = DataLoader(val_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded)
+
+    if args.benchmark == "vocab":
+        benchmark_vocab(dataset.output_lang)
+        return
+
+    if args.benchmark == "pruning":
+        benchmark_pruning(dataset.output_lang, model_settings["hidden_dim"], train_settings["batch_size"] * model_settings["max_seq_length"], args.repeats)
+        return
+
+    if args.benchmark == "collation":
+        benchmark_collation(train_dataset, train_settings["batch_size"], args.num_batches)
+        return
+
+    encoder, decoder = build_models(model_settings, dataset.input_lang.n_words, dataset.output_lang.n_words)
+
+    if args.benchmark == "loading":
+        # The same training pairs from the text files and from the token cache (in a temporary directory unless
+        # dataset_cache is set), as only the batches of a cached dataset are decoded lazily
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            other = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = args.directory, cache_dir = (tmp_dir if cache_dir is None else None), num_workers = train_settings["preprocessing_workers"], min_count = train_settings["min_word_count"], max_vocab_size = train_settings["max_vocab_size"] if isinstance(train_settings["max_vocab_size"], int) else None, tokenizer = train_settings["tokenizer"], bpe_merges = train_settings["bpe_merges"])
+            if cache_dir is None:
+                datasets = {"text": train_dataset, "cache": Subset(other, train_dataset.indices)}
+            else:
+                datasets = {"text": Subset(other, train_dataset.indices), "cache": train_dataset}
+            benchmark_loading(datasets, make_train_step(encoder, decoder), train_settings, args.num_batches)
+        return
+
+    if args.benchmark == "batching":
+        benchmark_batching(train_dataset, [dataset.lengths[i] for i in train_dataset.indices], encoder, decoder, train_settings, args.num_batches, generator)
+        return
+
+    # Early exit only pays off with a trained model, which actually produces EOS
+    if checkpoint_settings["checkpoint"].lower() != "none":
+        model = torch.load(checkpoint_settings["checkpoint"], map_location = device)
+        encoder.load_state_dict(model["encoder_state_dict"])
+        decoder.load_state_dict(model["decoder_state_dict"])
+
+    encoder.eval()
+    decoder.eval()
+
+    if args.benchmark == "early_exit":
+        benchmark_early_exit(val_dataloader, encoder, decoder, args.num_batches)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
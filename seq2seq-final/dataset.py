@@ -4,55 +4,381 @@ import torch
 import numpy as np
 import unicodedata
 import re
-from torch.utils.data import Dataset
+import os
+import hashlib
+import itertools
+import multiprocessing
+import weakref
+from array import array
+import copy
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info, default_collate
+from bpe import BPE
 
-device = torch.device("cpu")
-if torch.cuda.is_available():
-    device = torch.device("cuda")
+def unicode_to_ascii(s):
+    # Plain ASCII lines (most of Europarl English) have nothing to strip, so the per-character pass is skipped
+    if s.isascii():
+        return s
+    return "".join(
+        c for c in unicodedata.normalize("NFD", s)
+        if unicodedata.category(c) != "Mn"
+    )
+
+punctuation_pattern = re.compile(r"([.!?])")
+non_letter_pattern = re.compile(r"[^a-zA-Z!?]+")
+
+def normalize_string(s):
+    s = unicode_to_ascii(s.lower().strip())
+    s = punctuation_pattern.sub(r" \1", s)
+    s = non_letter_pattern.sub(r" ", s)
+    return s.strip()
+
+def normalize_lines(lines):
+    # Normalise a shard of aligned (lang1, lang2) lines, run in the worker processes
+    return [[normalize_string(line1), normalize_string(line2)] for line1, line2 in lines]
+
+def read_normalized_pairs(path1, path2, num_workers = 1, chunk_size = 10000, keep = None, num_shards = 1, shard_id = 0):
+    # Yields the normalised pairs of two aligned files lazily and in file order
+    # With num_workers > 1, shards of chunk_size lines are normalised in a process pool, and imap returns them in order
+    # keep(line_index) selects lines before they are normalised, and num_shards/shard_id then take every num_shards-th
+    # of the kept lines (e.g. one DataLoader worker's share)
+    with open(path1, mode = "r", encoding = "utf-8") as file1, open(path2, mode = "r", encoding = "utf-8") as file2:
+        lines = zip(file1, file2)
+        if keep is not None:
+            lines = (line for index, line in enumerate(lines) if keep(index))
+        if num_shards > 1:
+            lines = itertools.islice(lines, shard_id, None, num_shards)
+        chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers) as pool:
+                for chunk in pool.imap(normalize_lines, chunks):
+                    yield from chunk
+        else:
+            for chunk in chunks:
+                yield from normalize_lines(chunk)
+
+class WordTable:
+    # Read-only index -> word view of a Lang, in place of the old index2word dictionary
+    def __init__(self, lang):
+        self.lang = lang
+
+    def __len__(self):
+        return self.lang.n_words
+
+    def __contains__(self, index):
+        return 0 <= index < self.lang.n_words
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        return self.lang.word(index)
+
+    def get(self, index, default = None):
+        return self[index] if index in self else default
+
+class CountTable:
+    # Read-only word -> count view of a Lang, in place of the old word2count dictionary
+    def __init__(self, lang):
+        self.lang = lang
+
+    def __len__(self):
+        return self.lang.n_words - 2
+
+    def __contains__(self, word):
+        return word in self.lang.word2index
+
+    def __getitem__(self, word):
+        return int(self.lang.counts[self.lang.word2index[word]])
+
+    def get(self, word, default = None):
+        return self[word] if word in self else default
+
+    def items(self):
+        for index in range(2, self.lang.n_words):
+            yield self.lang.word(index), int(self.lang.counts[index])
+
+class UnknownWords(dict):
+    # word -> index dictionary of a pruned vocabulary, where any word outside the vocabulary maps to UNK
+    # Membership tests and get() still only see the kept words
+    def __init__(self, unk_index):
+        super().__init__()
+        self.unk_index = unk_index
+
+    def __missing__(self, word):
+        return self.unk_index
 
 class Lang:
+    # Vocabulary stored as one UTF-8 buffer of all words with an offset per word (for decoding) and a count array.
+    # The word -> index dictionary (for encoding) is the only per-word Python object, and it is rebuilt on first use
+    # after loading, so a memory-mapped vocabulary that is only decoded never creates it.
     def __init__(self, name):
         self.name = name
-        self.word2index = {}
-        self.word2count = {}
-        self.index2word = {0: "SOS", 1: "EOS"}
+        self.word_buffer = bytearray(b"SOSEOS")
+        self.word_offsets = array("q", [0, 3, 6])
+        self.counts = array("q", [0, 0])
         self.n_words = 2  # Count SOS and EOS
+        self.unk_index = None  # Only set for pruned vocabularies, see prune()
+        self.tokenizer = None  # None for words, or the BPE splitting words into the subwords of this vocabulary
+        self._word2index = {}
+
+    @property
+    def word2index(self):
+        if self._word2index is None:
+            self._word2index = {} if self.unk_index is None else UnknownWords(self.unk_index)
+            self._word2index.update((self.word(index), index) for index in range(2, self.n_words))
+        return self._word2index
+
+    @property
+    def index2word(self):
+        return WordTable(self)
+
+    @property
+    def word2count(self):
+        return CountTable(self)
+
+    def word(self, index):
+        return bytes(self.word_buffer[self.word_offsets[index]:self.word_offsets[index + 1]]).decode("utf-8")
+
+    def split(self, sentence):
+        # Tokens (words or subwords) of a sentence
+        if self.tokenizer is None:
+            return sentence.split(" ")
+        return self.tokenizer.encode(sentence)
+
+    def split_batch(self, sentences):
+        if self.tokenizer is None:
+            return [sentence.split(" ") for sentence in sentences]
+        return self.tokenizer.encode_batch(sentences)
+
+    def join(self, tokens):
+        # Inverse of split
+        if self.tokenizer is None:
+            return " ".join(tokens)
+        return self.tokenizer.decode(tokens)
 
     def addSentence(self, sentence):
-        for word in sentence.split(" "):
+        for word in self.split(sentence):
             self.addWord(word)
 
-    def addWord(self, word):
-        if word not in self.word2index:
+    def addWord(self, word, count = 1):
+        # A loaded vocabulary holds (possibly memory-mapped) NumPy arrays, which are copied into growable ones first
+        if not isinstance(self.counts, array):
+            self.word_buffer = bytearray(self.word_buffer)
+            self.word_offsets = array("q", self.word_offsets.tolist())
+            self.counts = array("q", self.counts.tolist())
+
+        index = self.word2index.get(word)
+        if index is None:
             self.word2index[word] = self.n_words
-            self.word2count[word] = 1
-            self.index2word[self.n_words] = word
+            self.word_buffer.extend(word.encode("utf-8"))
+            self.word_offsets.append(len(self.word_buffer))
+            self.counts.append(count)
             self.n_words += 1
         else:
-            self.word2count[word] += 1
+            self.counts[index] += count
+
+    def learn_subwords(self, num_merges = 10000):
+        # Returns a subword vocabulary with BPE merges learnt from the word counts of this (word) vocabulary, so the
+        # corpus is not read again. Subwords are numbered in order of first appearance over the words, and counted
+        # as often as the words containing them.
+        bpe = BPE.learn(self.word2count.items(), num_merges)
+        lang = Lang(self.name)
+        lang.tokenizer = bpe
+        for word, count in self.word2count.items():
+            for subword in bpe.encode_word(word):
+                lang.addWord(subword, count)
+        return lang
+
+    def prune(self, min_count = 1, max_size = None):
+        # Returns a vocabulary of the words seen at least min_count times, cut down to the max_size - 3 most frequent
+        # of them if max_size is given, with UNK (index 2) standing for every other word. The kept words keep their
+        # relative order. Also returns mapping, where mapping[old_index] is the new index of every old token id.
+        counts = np.asarray(self.counts, dtype = np.int64)
+        keep = counts >= min_count
+        keep[:2] = False
+        if self.unk_index is not None:
+            keep[self.unk_index] = False
+        kept = np.flatnonzero(keep)
+        if max_size is not None and len(kept) > max_size - 3:
+            kept = np.sort(kept[np.argsort(-counts[kept], kind = "stable")[:max(max_size - 3, 0)]])
+
+        lang = Lang(self.name)
+        lang.addWord("UNK")
+        for index in kept.tolist():
+            lang.addWord(self.word(index))
+        lang.counts = array("q", [0, 0, int(counts[2:].sum() - counts[kept].sum())] + counts[kept].tolist())
+        lang.unk_index = 2
+        lang.tokenizer = self.tokenizer
+        lang._word2index = None
+
+        mapping = np.full(self.n_words, lang.unk_index, dtype = np.int64)
+        mapping[:2] = np.arange(2)
+        mapping[kept] = np.arange(3, 3 + len(kept))
+        return lang, mapping
+
+    def __getstate__(self):
+        # Pickled (e.g. into seq2seq checkpoints) as the flat arrays only, plus the BPE merges (one "a b" per line)
+        state = {"name": self.name,
+                 "word_buffer": np.frombuffer(bytes(self.word_buffer), dtype = np.uint8),
+                 "word_offsets": np.array(self.word_offsets, dtype = np.int64),
+                 "counts": np.array(self.counts, dtype = np.int64),
+                 "unk_index": np.array(-1 if self.unk_index is None else self.unk_index, dtype = np.int64)}
+        if self.tokenizer is not None:
+            state["merges"] = "\n".join(f"{a} {b}" for a, b in self.tokenizer.merges)
+        return state
+
+    def __setstate__(self, state):
+        # Checkpoints saved before the compact vocabulary hold the three dictionaries instead
+        if "index2word" in state:
+            lang = Lang(state["name"])
+            for index in range(2, state["n_words"]):
+                word = state["index2word"][index]
+                lang.addWord(word)
+                lang.counts[index] = state["word2count"][word]
+            state = lang.__getstate__()
+
+        self.name = state["name"]
+        self.word_buffer = state["word_buffer"]
+        self.word_offsets = state["word_offsets"]
+        self.counts = state["counts"]
+        self.n_words = len(self.counts)
+        self.unk_index = int(state.get("unk_index", -1))
+        if self.unk_index < 0:
+            self.unk_index = None
+        self.tokenizer = None
+        if state.get("merges") is not None:
+            self.tokenizer = BPE([merge.split(" ") for merge in state["merges"].splitlines()])
+        self._word2index = None
+
+    def save(self, path):
+        # One .npy file per array, so that load() can memory-map them
+        os.makedirs(path, exist_ok = True)
+        for name, values in self.__getstate__().items():
+            if isinstance(values, str):
+                with open(os.path.join(path, f"{name}.txt"), mode = "w", encoding = "utf-8") as file:
+                    file.write(values)
+            else:
+                np.save(os.path.join(path, f"{name}.npy"), values)
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        with open(os.path.join(path, "name.txt"), mode = "r", encoding = "utf-8") as file:
+            state = {"name": file.read()}
+        for name in ["word_buffer", "word_offsets", "counts"]:
+            state[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode = ("r" if mmap == True else None))
+        if os.path.exists(os.path.join(path, "unk_index.npy")):
+            state["unk_index"] = np.load(os.path.join(path, "unk_index.npy"))
+        if os.path.exists(os.path.join(path, "merges.txt")):
+            with open(os.path.join(path, "merges.txt"), mode = "r", encoding = "utf-8") as file:
+                state["merges"] = file.read()
+        lang = cls.__new__(cls)
+        lang.__setstate__(state)
+        return lang
+
+class CachedPairs:
+    # Read-only view of the sentence pairs of a cached dataset, decoded back to text from the token ids on access.
+    # It only holds the (memory-mapped) token arrays and the two vocabularies, and a view loaded from a cache is
+    # pickled as the path of the cache, so a copy (e.g. in a batch sent from a DataLoader worker) reopens the files
+    # instead of carrying the corpus along
+    ARRAYS = ["input_ids", "input_offsets", "target_ids", "target_offsets"]
+    # Views open in this process by path, so a batch unpickled in the training process reuses the dataset's view
+    opened = weakref.WeakValueDictionary()
+
+    def __init__(self, input_lang, output_lang, input_ids, input_offsets, target_ids, target_offsets, path = None):
+        self.input_lang = input_lang
+        self.output_lang = output_lang
+        self.input_ids = input_ids
+        self.input_offsets = input_offsets
+        self.target_ids = target_ids
+        self.target_offsets = target_offsets
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        pairs = cls.opened.get(path)
+        if pairs is None:
+            input_lang = Lang.load(os.path.join(path, "input_lang"))
+            output_lang = Lang.load(os.path.join(path, "output_lang"))
+            arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode = "r") for name in cls.ARRAYS]
+            pairs = cls(input_lang, output_lang, *arrays, path = path)
+            cls.opened[path] = pairs
+        return pairs
+
+    @staticmethod
+    def decode_sentence(lang, ids, offsets, index):
+        # Inverse of TranslationDataset.tokenize_sentence (without the EOS token)
+        return lang.join([lang.index2word[i] for i in ids[offsets[index]:offsets[index + 1] - 1].tolist()])
+
+    def __len__(self):
+        return len(self.input_offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError("pair index out of range")
+        return [self.decode_sentence(self.input_lang, self.input_ids, self.input_offsets, index),
+                self.decode_sentence(self.output_lang, self.target_ids, self.target_offsets, index)]
+
+    def __reduce__(self):
+        if self.path is None:
+            return (CachedPairs, (self.input_lang, self.output_lang, self.input_ids, self.input_offsets, self.target_ids, self.target_offsets))
+        return (CachedPairs.load, (self.path,))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+class LazySentences:
+    # Input sentences of a batch from a cached dataset, only decoded from the token ids if they are actually read.
+    # Pickled with the indices and the CachedPairs view (as its path), so a batch from a DataLoader worker stays small
+    def __init__(self, pairs, indices):
+        self.pairs = pairs
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.pairs[self.indices[index]][0]
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.pairs[index][0]
+
+class PaddedBatch(tuple):
+    # (input_sentences, input_tensor, target_tensor) of a whole batch, as returned by TranslationDataset.__getitems__
+    pass
 
 class TranslationDataset(Dataset):
     SOS_token = 0
     EOS_token = 1
+    UNK_token = 2  # Only in pruned vocabularies
+    # Bump when the cache layout or the preprocessing changes, so old caches are rebuilt
+    CACHE_VERSION = 2
 
-    def __init__(self, lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = 50, reverse = False, directory = "../fr-en/"):
+    def __init__(self, lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = 50, reverse = False, directory = "../fr-en/", cache_dir = None, num_workers = 1, min_count = 1, max_vocab_size = None, tokenizer = "word", bpe_merges = 10000):
         self.lang1 = lang1
         self.lang2 = lang2
         self.directory = directory
         self.max_seq_len = max_seq_len
-        self.input_lang, self.output_lang, self.pairs = self.prepare_data(reverse)
+        self.num_workers = num_workers
+        # Words seen fewer than min_count times, or outside the max_vocab_size most frequent, become UNK
+        self.min_count = min_count
+        self.max_vocab_size = max_vocab_size
+        # "word" or "bpe" (subwords from bpe_merges merges learnt on this corpus)
+        self.tokenizer = tokenizer
+        self.bpe_merges = bpe_merges
+        if cache_dir is not None:
+            self.input_lang, self.output_lang, self.pairs = self.load_cache(cache_dir, reverse)
+        else:
+            self.input_lang, self.output_lang, self.pairs = self.prepare_data(reverse)
+            self.pairs = self.tokenize_pairs(self.pairs)
+        # Number of tokens (with EOS) of the longer sentence in each pair, used for length bucketing
+        self.lengths = np.maximum(np.diff(self.input_offsets), np.diff(self.target_offsets))
 
     def __len__(self):
         return len(self.pairs)
 
     def load_data(self, reverse = False):
-        pairs = []
-        with open(f"{self.directory}{self.lang1}", mode = "r", encoding = "utf-8") as en_file, open(
-                f"{self.directory}{self.lang2}", mode = "r", encoding = "utf-8") as fr_file:
-            en_lines = en_file.readlines()
-            fr_lines = fr_file.readlines()
-            for en_line, fr_line in zip(en_lines, fr_lines):
-                pairs.append([self.normalize_string(en_line), self.normalize_string(fr_line)])
+        pairs = list(read_normalized_pairs(f"{self.directory}{self.lang1}", f"{self.directory}{self.lang2}", num_workers = self.num_workers))
 
         # Reverse pairs, make Lang instances
         if reverse:
@@ -77,10 +403,28 @@ class TranslationDataset(Dataset):
         print("Counted words:")
         print(input_lang.name, input_lang.n_words)
         print(output_lang.name, output_lang.n_words)
-        self.input_lang_voc = input_lang.word2index
-        self.output_lang_voc = output_lang.word2index
+        input_lang = self.learn_subwords(input_lang)
+        output_lang = self.learn_subwords(output_lang)
+        input_lang, _ = self.prune_lang(input_lang)
+        output_lang, _ = self.prune_lang(output_lang)
         return input_lang, output_lang, pairs
 
+    def learn_subwords(self, lang):
+        # Returns the subword vocabulary of a word vocabulary with the "bpe" tokenizer, otherwise lang itself
+        if self.tokenizer != "bpe":
+            return lang
+        subword_lang = lang.learn_subwords(self.bpe_merges)
+        print("Learnt %s subwords for %s" % (subword_lang.n_words, lang.name))
+        return subword_lang
+
+    def prune_lang(self, lang):
+        # Returns lang and None if no pruning is asked for, otherwise the pruned vocabulary and the token id mapping
+        if self.min_count <= 1 and self.max_vocab_size is None:
+            return lang, None
+        pruned_lang, mapping = lang.prune(self.min_count, self.max_vocab_size)
+        print("Pruned %s to %s words" % (lang.name, pruned_lang.n_words))
+        return pruned_lang, mapping
+
     def filter_pair(self, p):
         return len(p[0].split(" ")) < self.max_seq_len and \
                len(p[1].split(" ")) < self.max_seq_len
@@ -89,33 +433,364 @@ class TranslationDataset(Dataset):
         return [pair for pair in pairs if self.filter_pair(pair)]
 
     def unicode_to_ascii(self, s):
-        return "".join(
-            c for c in unicodedata.normalize("NFD", s)
-            if unicodedata.category(c) != "Mn"
-        )
+        return unicode_to_ascii(s)
 
     def normalize_string(self, s):
-        s = self.unicode_to_ascii(s.lower().strip())
-        s = re.sub(r"([.!?])", r" \1", s)
-        s = re.sub(r"[^a-zA-Z!?]+", r" ", s)
-        return s.strip()
+        return normalize_string(s)
 
     def tokenize_sentence(self, lang, sentence):
-        tokenized_sentence = [lang[word] for word in sentence.split(" ")]
+        word2index = lang.word2index
+        tokenized_sentence = [word2index[token] for token in lang.split(sentence)]
         tokenized_sentence.append(self.EOS_token)
         return tokenized_sentence
 
+    def tokenize_sentences(self, lang, sentences):
+        word2index = lang.word2index
+        return [[word2index[token] for token in tokens] + [self.EOS_token] for tokens in lang.split_batch(sentences)]
+
     def tokenize_pair(self, pair):
-        input_tensor = self.tokenize_sentence(self.input_lang_voc, pair[0])
-        target_tensor = self.tokenize_sentence(self.output_lang_voc, pair[1])
+        input_tensor = self.tokenize_sentence(self.input_lang, pair[0])
+        target_tensor = self.tokenize_sentence(self.output_lang, pair[1])
         return (input_tensor, target_tensor)
 
+    def fits(self, input_tokens, target_tokens):
+        # Pairs are filtered on their words, but subwords can still take them past max_seq_len tokens
+        return len(input_tokens) <= self.max_seq_len and len(target_tokens) <= self.max_seq_len
+
+    def flatten(self, sentences):
+        # Token ids of all sentences in one flat array, with ids[offsets[i]:offsets[i + 1]] holding sentence i
+        offsets = np.zeros(len(sentences) + 1, dtype = np.int64)
+        np.cumsum([len(sentence) for sentence in sentences], out = offsets[1:])
+        ids = np.fromiter(itertools.chain.from_iterable(sentences), dtype = np.int32, count = offsets[-1])
+        return ids, offsets
+
+    def tokenize_pairs(self, pairs, chunk_size = 10000):
+        # Tokenize every pair once up front, instead of on each access, a chunk of sentences at a time
+        # Returns the pairs that fit in max_seq_len tokens
+        kept_pairs, input_sentences, target_sentences = [], [], []
+        for start in range(0, len(pairs), chunk_size):
+            chunk = pairs[start:start + chunk_size]
+            input_chunk = self.tokenize_sentences(self.input_lang, [pair[0] for pair in chunk])
+            target_chunk = self.tokenize_sentences(self.output_lang, [pair[1] for pair in chunk])
+            for pair, input_tokens, target_tokens in zip(chunk, input_chunk, target_chunk):
+                if self.fits(input_tokens, target_tokens):
+                    kept_pairs.append(pair)
+                    input_sentences.append(input_tokens)
+                    target_sentences.append(target_tokens)
+        if len(kept_pairs) < len(pairs):
+            print("Trimmed to %s sentence pairs that fit in %s tokens" % (len(kept_pairs), self.max_seq_len))
+
+        self.input_ids, self.input_offsets = self.flatten(input_sentences)
+        self.target_ids, self.target_offsets = self.flatten(target_sentences)
+        return kept_pairs
+
+    def stream_tokens(self, reverse = False):
+        # Same result as prepare_data followed by tokenize_pairs, but each pair is counted and tokenized as soon as it
+        # is normalised, so only the token ids are kept in memory. Lang assigns ids in order of first appearance,
+        # so the ids match those of the full pass.
+        # Subwords are learnt from the word counts of the whole corpus, so with the "bpe" tokenizer a first pass
+        # counts the words and the second one tokenizes.
+        input_lang = Lang(self.lang2 if reverse else self.lang1)
+        output_lang = Lang(self.lang1 if reverse else self.lang2)
+        if self.tokenizer == "bpe":
+            for pair in read_normalized_pairs(f"{self.directory}{self.lang1}", f"{self.directory}{self.lang2}", num_workers = self.num_workers):
+                if reverse:
+                    pair = list(reversed(pair))
+                if self.filter_pair(pair):
+                    input_lang.addSentence(pair[0])
+                    output_lang.addSentence(pair[1])
+            print("Counted words:")
+            print(input_lang.name, input_lang.n_words)
+            print(output_lang.name, output_lang.n_words)
+            input_lang = self.learn_subwords(input_lang)
+            output_lang = self.learn_subwords(output_lang)
+
+        input_ids, target_ids = array("i"), array("i")
+        input_lengths, target_lengths = array("q"), array("q")
+
+        n_pairs = 0
+        for pair in read_normalized_pairs(f"{self.directory}{self.lang1}", f"{self.directory}{self.lang2}", num_workers = self.num_workers):
+            n_pairs += 1
+            if reverse:
+                pair = list(reversed(pair))
+            if not self.filter_pair(pair):
+                continue
+            if self.tokenizer != "bpe":
+                input_lang.addSentence(pair[0])
+                output_lang.addSentence(pair[1])
+            input_tokens, target_tokens = self.tokenize_sentence(input_lang, pair[0]), self.tokenize_sentence(output_lang, pair[1])
+            if not self.fits(input_tokens, target_tokens):
+                continue
+            for ids, lengths, tokenized_sentence in [(input_ids, input_lengths, input_tokens), (target_ids, target_lengths, target_tokens)]:
+                ids.extend(tokenized_sentence)
+                lengths.append(len(tokenized_sentence))
+
+        print("Read %s sentence pairs" % n_pairs)
+        print("Trimmed to %s sentence pairs" % len(input_lengths))
+        if self.tokenizer != "bpe":
+            print("Counted words:")
+            print(input_lang.name, input_lang.n_words)
+            print(output_lang.name, output_lang.n_words)
+
+        # The vocabularies are only complete at the end, so pruning maps the ids of the full vocabularies afterwards
+        input_lang, input_mapping = self.prune_lang(input_lang)
+        output_lang, output_mapping = self.prune_lang(output_lang)
+
+        for name, ids, lengths, mapping in [("input", input_ids, input_lengths, input_mapping), ("target", target_ids, target_lengths, output_mapping)]:
+            offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+            np.cumsum(np.frombuffer(lengths, dtype = np.int64), out = offsets[1:])
+            ids = np.frombuffer(ids, dtype = np.int32)
+            if mapping is not None:
+                ids = mapping.astype(np.int32)[ids]
+            setattr(self, f"{name}_ids", ids)
+            setattr(self, f"{name}_offsets", offsets)
+
+        return input_lang, output_lang
+
+    def cache_key(self, reverse):
+        # Hash of the source files and of everything that changes the preprocessed pairs
+        key = hashlib.sha1(f"{self.CACHE_VERSION} {self.max_seq_len} {reverse} {self.min_count} {self.max_vocab_size} {self.tokenizer} {self.bpe_merges}".encode("utf-8"))
+        for name in [self.lang1, self.lang2]:
+            with open(f"{self.directory}{name}", mode = "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    key.update(chunk)
+        return key.hexdigest()
+
+    def save_cache(self, path, input_lang, output_lang):
+        # Written to a temporary directory first, so an interrupted run never leaves a partial cache behind
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok = True)
+        for name in ["input_ids", "input_offsets", "target_ids", "target_offsets"]:
+            np.save(os.path.join(tmp_path, f"{name}.npy"), getattr(self, name))
+        input_lang.save(os.path.join(tmp_path, "input_lang"))
+        output_lang.save(os.path.join(tmp_path, "output_lang"))
+        os.replace(tmp_path, path)
+
+    def load_cache(self, cache_dir, reverse = False):
+        # Token ids and vocabularies are memory-mapped from flat .npy files
+        path = os.path.join(cache_dir, self.cache_key(reverse))
+        if not os.path.exists(path):
+            print("Building dataset cache in %s" % path)
+            os.makedirs(cache_dir, exist_ok = True)
+            input_lang, output_lang = self.stream_tokens(reverse)
+            self.save_cache(path, input_lang, output_lang)
+
+        pairs = CachedPairs.load(path)
+        for name in CachedPairs.ARRAYS:
+            setattr(self, name, getattr(pairs, name))
+        print("Loaded %s sentence pairs from %s" % (len(pairs), path))
+
+        return pairs.input_lang, pairs.output_lang, pairs
+
+    def pad_sentences(self, ids, offsets, indices):
+        # Gathers the sentences at indices into a zero-padded len(indices) x max_seq_len array with one fancy index
+        starts = offsets[indices]
+        lengths = offsets[indices + 1] - starts
+        positions = np.arange(self.max_seq_len)
+        mask = positions < lengths[:, None]
+        padded = np.zeros((len(indices), self.max_seq_len), dtype = np.int64)
+        padded[mask] = ids[(starts[:, None] + positions)[mask]]
+        return padded
+
+    def __getitems__(self, indices):
+        # Batched fetch used by the DataLoader in place of one __getitem__ per pair. Subclasses that hold their own
+        # pairs without token arrays (see inference.ipynb) fall back to __getitem__.
+        if not hasattr(self, "input_offsets"):
+            return [self[index] for index in indices]
+
+        if isinstance(self.pairs, list):
+            input_sentences = [self.pairs[index][0] for index in indices]
+        else:
+            input_sentences = LazySentences(self.pairs, indices)
+        indices = np.asarray(indices, dtype = np.int64)
+        input_tensor = torch.from_numpy(self.pad_sentences(self.input_ids, self.input_offsets, indices))
+        target_tensor = torch.from_numpy(self.pad_sentences(self.target_ids, self.target_offsets, indices))
+        return PaddedBatch((input_sentences, input_tensor, target_tensor))
+
     def __getitem__(self, index):
         input_sentence = self.pairs[index][0]
-        output_sentence = self.pairs[index][1]
-        in_sentence, out_sentence = self.tokenize_pair((input_sentence, output_sentence))
+        in_sentence = self.input_ids[self.input_offsets[index]:self.input_offsets[index + 1]]
+        out_sentence = self.target_ids[self.target_offsets[index]:self.target_offsets[index + 1]]
         input_ids = np.zeros(self.max_seq_len, dtype = np.int32)
         target_ids = np.zeros(self.max_seq_len, dtype = np.int32)
         input_ids[:len(in_sentence)] = in_sentence
         target_ids[:len(out_sentence)] = out_sentence
-        return input_sentence, torch.tensor(input_ids, dtype = torch.long, device = device), torch.tensor(target_ids, dtype = torch.long, device = device)
\ No newline at end of file
+        # CPU tensors, so batches can be built in DataLoader workers and pinned, the training loop moves them to the GPU
+        return input_sentence, torch.tensor(input_ids, dtype = torch.long), torch.tensor(target_ids, dtype = torch.long)
+
+class StreamingTranslationDataset(IterableDataset):
+    # Streams aligned pairs from the text files, normalising, filtering and tokenizing them on the fly, so memory use
+    # stays flat however large the corpus is. One pass at construction builds the vocabularies (unless they are given)
+    # and counts the pairs. Every val_every-th line is held out for validation, see subset().
+    SOS_token = 0
+    EOS_token = 1
+
+    def __init__(self, lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = 50, reverse = False, directory = "../fr-en/", input_lang = None, output_lang = None, shuffle_buffer = 0, val_every = 5, min_count = 1, max_vocab_size = None, tokenizer = "word", bpe_merges = 10000):
+        self.lang1 = lang1
+        self.lang2 = lang2
+        self.directory = directory
+        self.max_seq_len = max_seq_len
+        self.reverse = reverse
+        self.shuffle_buffer = shuffle_buffer
+        self.val_every = val_every
+        self.split = "all"
+
+        # Pairs with words outside given vocabularies (e.g. a test set read with the training vocabularies) are skipped,
+        # unless the vocabularies are pruned, in which case those words become UNK
+        build_vocab = input_lang is None or output_lang is None
+        if build_vocab == True:
+            input_lang = Lang(lang2 if reverse else lang1)
+            output_lang = Lang(lang1 if reverse else lang2)
+        self.input_lang = input_lang
+        self.output_lang = output_lang
+
+        self.split_sizes = {"train": 0, "val": 0}
+        for index, pair in self.read_pairs():
+            if build_vocab == True:
+                self.input_lang.addSentence(pair[0])
+                self.output_lang.addSentence(pair[1])
+            elif self.tokenize_pair(pair) is None:
+                continue
+            self.split_sizes[self.split_of(index)] += 1
+
+        # Subwords are learnt from the counted words, and can take pairs past max_seq_len, so the pairs are counted again
+        if build_vocab == True and tokenizer == "bpe":
+            self.input_lang = self.input_lang.learn_subwords(bpe_merges)
+            self.output_lang = self.output_lang.learn_subwords(bpe_merges)
+            self.split_sizes = {"train": 0, "val": 0}
+            for index, pair in self.read_pairs():
+                if self.tokenize_pair(pair) is not None:
+                    self.split_sizes[self.split_of(index)] += 1
+
+        # Built vocabularies are pruned once counted, the pairs are only tokenized while iterating
+        if build_vocab == True and (min_count > 1 or max_vocab_size is not None):
+            self.input_lang, _ = self.input_lang.prune(min_count, max_vocab_size)
+            self.output_lang, _ = self.output_lang.prune(min_count, max_vocab_size)
+            print("Pruned vocabularies to %s and %s words" % (self.input_lang.n_words, self.output_lang.n_words))
+        print("Streaming %s training and %s validation sentence pairs" % (self.split_sizes["train"], self.split_sizes["val"]))
+
+    def __len__(self):
+        if self.split == "all":
+            return self.split_sizes["train"] + self.split_sizes["val"]
+        return self.split_sizes[self.split]
+
+    def split_of(self, index):
+        return "val" if index % self.val_every == self.val_every - 1 else "train"
+
+    def subset(self, split):
+        # The "train" or "val" part of the corpus, sharing the vocabularies. Validation pairs are never shuffled.
+        dataset = copy.copy(self)
+        dataset.split = split
+        if split == "val":
+            dataset.shuffle_buffer = 0
+        return dataset
+
+    def read_pairs(self, num_shards = 1, shard_id = 0):
+        # Yields (line index, pair) for the pairs of this split that pass the length filter
+        keep = None if self.split == "all" else (lambda index: self.split_of(index) == self.split)
+        lines = read_normalized_pairs(f"{self.directory}{self.lang1}", f"{self.directory}{self.lang2}", keep = keep, num_shards = num_shards, shard_id = shard_id)
+        for index, pair in enumerate(lines):
+            if self.reverse == True:
+                pair = list(reversed(pair))
+            if len(pair[0].split(" ")) < self.max_seq_len and len(pair[1].split(" ")) < self.max_seq_len:
+                yield index, pair
+
+    def tokenize_pair(self, pair):
+        try:
+            input_ids = [self.input_lang.word2index[token] for token in self.input_lang.split(pair[0])] + [self.EOS_token]
+            target_ids = [self.output_lang.word2index[token] for token in self.output_lang.split(pair[1])] + [self.EOS_token]
+        except KeyError:
+            return None
+        # Subwords can take a pair past max_seq_len tokens
+        if len(input_ids) > self.max_seq_len or len(target_ids) > self.max_seq_len:
+            return None
+        return input_ids, target_ids
+
+    def shuffle(self, pairs, generator):
+        # Keeps shuffle_buffer pairs and emits a random one of them for every new pair read
+        buffer = []
+        for pair in pairs:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(pair)
+                continue
+            i = torch.randint(len(buffer), (1,), generator = generator).item()
+            yield buffer[i]
+            buffer[i] = pair
+        for i in torch.randperm(len(buffer), generator = generator).tolist():
+            yield buffer[i]
+
+    def __iter__(self):
+        # Each DataLoader worker reads its own share of the lines, and the DataLoader's per-worker, per-epoch seed
+        # drives the shuffle (the global torch seed without workers)
+        worker_info = get_worker_info()
+        if worker_info is None:
+            num_shards, shard_id = 1, 0
+            seed = torch.empty((), dtype = torch.int64).random_().item()
+        else:
+            num_shards, shard_id, seed = worker_info.num_workers, worker_info.id, worker_info.seed
+
+        pairs = (pair for _, pair in self.read_pairs(num_shards, shard_id))
+        if self.shuffle_buffer > 1:
+            pairs = self.shuffle(pairs, torch.Generator().manual_seed(seed))
+
+        for pair in pairs:
+            tokenized_pair = self.tokenize_pair(pair)
+            if tokenized_pair is None:
+                continue
+            input_ids = np.zeros(self.max_seq_len, dtype = np.int32)
+            target_ids = np.zeros(self.max_seq_len, dtype = np.int32)
+            input_ids[:len(tokenized_pair[0])] = tokenized_pair[0]
+            target_ids[:len(tokenized_pair[1])] = tokenized_pair[1]
+            yield pair[0], torch.tensor(input_ids, dtype = torch.long), torch.tensor(target_ids, dtype = torch.long)
+
+class BucketBatchSampler(Sampler):
+    # Groups pairs of similar length into batches, so that each batch only needs padding to its longest sentence
+    # Batches hold batch_size pairs, or with max_tokens as many pairs as fit in that budget (pairs x padded length)
+    def __init__(self, lengths, batch_size = 64, max_tokens = None, shuffle = True, generator = None):
+        self.lengths = torch.as_tensor(lengths)
+        self.shuffle = shuffle
+        self.generator = generator
+
+        # Batch boundaries over the pairs sorted by length, which are the same for every epoch
+        sorted_lengths = self.lengths.sort().values.tolist()
+        self.batch_sizes = []
+        start = 0
+        while start < len(sorted_lengths):
+            if max_tokens is None:
+                size = min(batch_size, len(sorted_lengths) - start)
+            else:
+                # Lengths are ascending, so the last pair added is the longest in the batch
+                size = 1
+                while start + size < len(sorted_lengths) and (size + 1) * sorted_lengths[start + size] <= max_tokens:
+                    size += 1
+            self.batch_sizes.append(size)
+            start += size
+
+    def __iter__(self):
+        if self.shuffle == True:
+            # Shuffle pairs of equal length among themselves, then shuffle the order of the batches
+            order = torch.randperm(len(self.lengths), generator = self.generator)
+            order = order[self.lengths[order].sort(stable = True).indices]
+            batches = torch.split(order, self.batch_sizes)
+            batches = [batches[i] for i in torch.randperm(len(batches), generator = self.generator)]
+        else:
+            batches = torch.split(self.lengths.sort(stable = True).indices, self.batch_sizes)
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.batch_sizes)
+
+def collate_padded(batch):
+    # A batch fetched with __getitems__ is already stacked and padded, a list of pairs goes through the default collate
+    if isinstance(batch, PaddedBatch):
+        return batch
+    return default_collate(batch)
+
+def collate_batch(batch):
+    # Stack a batch and cut the padding down to its longest sentence
+    # Source and target keep the same length, which the Transformer needs
+    input_sentences, input_tensor, target_tensor = collate_padded(batch)
+    max_len = max((input_tensor != 0).sum(dim = 1).max().item(), (target_tensor != 0).sum(dim = 1).max().item())
+    return input_sentences, input_tensor[:, :max_len].contiguous(), target_tensor[:, :max_len].contiguous()
\ No newline at end of file
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from beam_search import beam_search
+
 device = torch.device("cpu")
 if torch.cuda.is_available():
     device = torch.device("cuda")
@@ -38,14 +40,23 @@ class EncoderRNN(nn.Module):
         # X.shape = (num_layers, batch_size, num_directions, hidden_size)
         return X.contiguous().view(self.num_layers, batch_size, -1) 
 
-    def forward(self, input, hidden = None):
-        batch_size, _ = input.shape
+    def forward(self, input, hidden = None, lengths = None):
+        batch_size, seq_len = input.shape
 
         # Apply dropout to input embeddings
         embedded = self.dropout(self.embedding(input))
+
+        # Pack with the source lengths, so the GRU stops at each sentence's true length and padding never reaches the hidden state
+        if lengths is not None:
+            embedded = nn.utils.rnn.pack_padded_sequence(embedded, lengths.cpu(), batch_first = True, enforce_sorted = False)
+
         # Forward pass through GRU layer
         output, hidden = self.gru(embedded, hidden)
 
+        # Padding positions of the output are zeros
+        if lengths is not None:
+            output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first = True, total_length = seq_len)
+
         # Sum bidirectional outputs and concatenate hidden
         if self.bidirectional == True:
             output = (output[:, :, :self.hidden_size] + output[:, :, self.hidden_size:])
@@ -76,24 +87,37 @@ class DecoderRNN(nn.Module):
 
         self.out = nn.Linear(hidden_size, output_size)
 
-    def forward(self, encoder_outputs, encoder_hidden, target_tensor = None, teacher_forcing_ratio = 0.9):
+    def forward(self, encoder_outputs, encoder_hidden, target_tensor = None, teacher_forcing_ratio = 0.9, max_seq_len = None):
         batch_size = encoder_outputs.size(0)
         decoder_input = torch.empty(batch_size, 1, dtype = torch.long, device = device).fill_(self.SOS_token)
+        decoder_hidden = self.init_hidden(encoder_hidden)
 
-        if self.use_lstm == True:
-            decoder_hidden = (encoder_hidden[-self.num_layers:], torch.zeros_like(encoder_hidden[-self.num_layers:]))
-        else:
-            decoder_hidden = encoder_hidden[-self.num_layers:]
+        # Unroll for as many steps as the target (which may be cut to its longest sentence), or max_seq_len without one
+        if max_seq_len is None:
+            max_seq_len = target_tensor.size(1) if target_tensor is not None else self.max_seq_len
+
+        # Full teacher forcing: every input is known up front, so the shifted target runs through the GRU/LSTM in a single call
+        if (target_tensor is not None) and (teacher_forcing_ratio >= 1):
+            decoder_input = torch.cat([decoder_input, target_tensor[:, :max_seq_len - 1]], dim = 1)
+            decoder_outputs, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
+            # The output distribution (and so the loss) is always float32, also under autocast
+            decoder_outputs = F.log_softmax(decoder_outputs.float(), dim = -1)
+
+            return decoder_outputs, decoder_hidden, None
+
+        # Scheduled sampling: draw the teacher forcing coin flips for the whole sequence at once (a single host sync)
+        if target_tensor is not None:
+            use_teacher_forcing = (torch.rand(max_seq_len) < teacher_forcing_ratio).tolist()
 
         decoder_outputs = []
 
-        for i in range(self.max_seq_len):
+        for i in range(max_seq_len):
             decoder_output, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
 
             decoder_outputs.append(decoder_output)
 
             # Teacher forcing: Feed the target as the next input
-            if (target_tensor is not None) and (torch.rand(1).item() < teacher_forcing_ratio):
+            if (target_tensor is not None) and use_teacher_forcing[i]:
                 decoder_input = target_tensor[:, i].unsqueeze(1) # Teacher forcing
             # Without teacher forcing: Use its own predictions as the next input
             else:
@@ -101,10 +125,67 @@ class DecoderRNN(nn.Module):
                 decoder_input = topi.squeeze(-1).detach() # Detach from history as input
 
         decoder_outputs = torch.cat(decoder_outputs, dim = 1)
-        decoder_outputs = F.log_softmax(decoder_outputs, dim = -1)
+        decoder_outputs = F.log_softmax(decoder_outputs.float(), dim = -1)
 
         return decoder_outputs, decoder_hidden, None # We return 'None' for consistency in the training loop, or the attentions
 
+    def generate(self, encoder_outputs, encoder_hidden, compact = False):
+        # Greedy decoding for inference, which stops as soon as every sentence in the batch has produced EOS
+        # With compact = True, finished sentences are also dropped from the batch so they stop using GRU/LSTM compute
+        batch_size = encoder_outputs.size(0)
+        decoder_input = torch.empty(batch_size, 1, dtype = torch.long, device = device).fill_(self.SOS_token)
+        decoder_hidden = self.init_hidden(encoder_hidden)
+
+        # Padded with zeros after EOS, as in the dataset targets
+        decoded_ids = torch.zeros(batch_size, self.max_seq_len, dtype = torch.long, device = device)
+        # Rows of decoded_ids that are still being decoded
+        active = torch.arange(batch_size, device = device)
+        finished = torch.zeros(batch_size, dtype = torch.bool, device = device)
+
+        for i in range(self.max_seq_len):
+            decoder_output, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
+            decoder_input = decoder_output.argmax(-1).detach()
+            tokens = decoder_input.squeeze(1)
+
+            if compact == True:
+                decoded_ids[active, i] = tokens
+                unfinished = tokens != self.EOS_token
+                if not unfinished.all():
+                    active = active[unfinished]
+                    if len(active) == 0:
+                        break
+                    decoder_input = decoder_input[unfinished]
+                    decoder_hidden = tuple(h[:, unfinished] for h in decoder_hidden) if self.use_lstm == True else decoder_hidden[:, unfinished]
+            else:
+                decoded_ids[:, i] = tokens.masked_fill(finished, 0)
+                finished = finished | (tokens == self.EOS_token)
+                if finished.all():
+                    break
+
+        return decoded_ids[:, :i + 1]
+
+    def init_hidden(self, encoder_hidden):
+        # Initialise from the last layers of the encoder hidden state (the LSTM cell state starts at zero)
+        if self.use_lstm == True:
+            return (encoder_hidden[-self.num_layers:], torch.zeros_like(encoder_hidden[-self.num_layers:]))
+        return encoder_hidden[-self.num_layers:]
+
+    def beam_search(self, encoder_outputs, encoder_hidden, beam_size = 4, n_best = 1, alpha = 0.6):
+        # Returns the n best hypotheses per sentence (batch_size x n_best x steps) and their scores
+        batch_size = encoder_outputs.size(0)
+
+        def step(decoder_input, decoder_hidden):
+            decoder_output, decoder_hidden = self.forward_step(decoder_input, decoder_hidden)
+            return F.log_softmax(decoder_output.squeeze(1), dim = -1), decoder_hidden
+
+        # The hidden state is (num_layers, batch_size, hidden_size), so beams are selected along dimension 1
+        def reorder(decoder_hidden, index):
+            if self.use_lstm == True:
+                return tuple(h.index_select(1, index) for h in decoder_hidden)
+            return decoder_hidden.index_select(1, index)
+
+        return beam_search(step, self.init_hidden(encoder_hidden), batch_size, encoder_outputs.device, beam_size = beam_size, max_len = self.max_seq_len, reorder = reorder, n_best = n_best, alpha = alpha, SOS_token = self.SOS_token, EOS_token = self.EOS_token)
+
     def forward_step(self, input, hidden):
         output = self.embedding(input)
         output = F.relu(output)
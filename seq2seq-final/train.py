@@ -1,5 +1,6 @@
 import os
 import time
+import itertools
 import torch
 import wandb
 import torch.nn as nn
@@ -9,14 +10,14 @@ import matplotlib.pyplot as plt
 import numpy as np
 import random
 
-from dataset import TranslationDataset
+from dataset import TranslationDataset, StreamingTranslationDataset, BucketBatchSampler, collate_batch, collate_padded
 from logger import Logger
 from models import EncoderRNN, DecoderRNN
 from attention_models import SelfAttention
 
 from torch.utils.data import DataLoader, random_split
 
-from utils import parse_arguments, read_settings, calculate_bleu, calculate_nist, scheduled_sampling
+from utils import parse_arguments, read_settings, CorpusMetrics, make_metrics, autocast, grad_scaler, scheduled_sampling
 
 device = torch.device("cpu")
 if torch.cuda.is_available():
@@ -24,83 +25,116 @@ if torch.cuda.is_available():
 
 print(device)
 
-def train_epoch(train_dataloader, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, output_lang, teacher_forcing_ratio = 0.5, grad_clip = None, self_attention = None):
+def train_epoch(train_dataloader, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, output_lang, teacher_forcing_ratio = 0.5, grad_clip = None, self_attention = None, metric_every = 1, async_metrics = False, precision = "fp32", scaler = None, accumulation_steps = 1):
     encoder.train()
     decoder.train()
     
     total_loss = 0
-    total_bleu_score = 0
-    total_nist_score = 0
+    # Corpus BLEU and NIST over every metric_every-th batch of the epoch, computed on the device with only occasional
+    # syncs (when the n-gram counts are merged), or in a background thread with async_metrics
+    metrics = make_metrics(async_metrics)
+
+    # Time spent waiting for the next batch, reported as a share of the epoch
+    data_time = 0
+    epoch_start = time.perf_counter()
+    data_start = epoch_start
     
-    for data in train_dataloader:
-        input_sentence, input_tensor, target_tensor = data
+    # Every optimiser step accumulates the gradients of accumulation_steps batches (micro-batches)
+    batches = iter(train_dataloader)
+    batch_index = 0
+
+    while True:
+        group = list(itertools.islice(batches, accumulation_steps))
+        data_time += time.perf_counter() - data_start
+        if len(group) == 0:
+            break
+
+        # Target tokens the loss of each micro-batch is averaged over (every position, unless the loss ignores padding).
+        # Each loss is weighted by its share of the tokens of the group, so the step averages over tokens as one batch
+        # holding all of them would
+        tokens = [(target_tensor != criterion.ignore_index).sum().item() for _, _, target_tensor in group]
+        group_tokens = sum(tokens)
 
         encoder_optimizer.zero_grad()
         decoder_optimizer.zero_grad()
 
-        encoder_outputs, encoder_hidden = encoder(input_tensor)
-        
-        if self_attention is not None:
-            encoder_outputs, att = self_attention(encoder_outputs)
-        
-        decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, target_tensor, teacher_forcing_ratio = teacher_forcing_ratio)
+        for (input_sentence, input_tensor, target_tensor), micro_tokens in zip(group, tokens):
+            # Batches come from the DataLoader on the CPU, pinned batches are copied to the GPU asynchronously
+            input_tensor = input_tensor.to(device, non_blocking = True)
+            target_tensor = target_tensor.to(device, non_blocking = True)
+
+            # Forward pass in reduced precision with bf16/fp16 (the decoder outputs and loss stay float32)
+            with autocast(precision):
+                # Padding is 0, so the encoder can skip it using the true source lengths
+                input_lengths = (input_tensor != 0).sum(dim = 1)
+                encoder_outputs, encoder_hidden = encoder(input_tensor, lengths = input_lengths)
+                
+                if self_attention is not None:
+                    encoder_outputs, att = self_attention(encoder_outputs)
+                
+                decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, target_tensor, teacher_forcing_ratio = teacher_forcing_ratio)
+
+                loss = criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
+            
+            # Through the gradient scaler for fp16
+            scaler.scale(loss * (micro_tokens / group_tokens)).backward()
 
-        loss = criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
-        
-        loss.backward()
+            total_loss += loss.item()
+
+            # Accumulate BLEU and NIST statistics
+            if batch_index % metric_every == 0:
+                metrics.update(decoder_outputs.detach(), target_tensor)
+            batch_index += 1
 
         if isinstance(grad_clip, int) or isinstance(grad_clip, float):
+            # Clip the true gradients, not the scaled ones
+            scaler.unscale_(encoder_optimizer)
+            scaler.unscale_(decoder_optimizer)
             torch.nn.utils.clip_grad_norm_(encoder.parameters(), grad_clip)
             torch.nn.utils.clip_grad_norm_(decoder.parameters(), grad_clip)
 
-        encoder_optimizer.step()
-        decoder_optimizer.step()
-
-        total_loss += loss.item()
+        # Skipped if the fp16 gradients overflowed, the scale is then lowered for the next step
+        scaler.step(encoder_optimizer)
+        scaler.step(decoder_optimizer)
+        scaler.update()
 
-        # Calculate BLEU score
-        bleu_score = calculate_bleu(decoder_outputs, target_tensor)
-        total_bleu_score += bleu_score
+        data_start = time.perf_counter()
 
-        # Calculate NIST score
-        nist_score = calculate_nist(decoder_outputs, target_tensor)
-        total_nist_score += nist_score
+    data_wait = data_time / (time.perf_counter() - epoch_start)
 
     if self_attention is not None:
         plot_attention_self(att[0, :, :])
 
-    return total_loss / len(train_dataloader), total_bleu_score / len(train_dataloader), total_nist_score / len(train_dataloader)
+    return total_loss / len(train_dataloader), metrics.bleu(), metrics.nist(), data_wait
 
-def validate_epoch(val_dataloader, encoder, decoder, criterion):
+def validate_epoch(val_dataloader, encoder, decoder, criterion, precision = "fp32"):
     encoder.eval()
     decoder.eval()
 
     total_loss = 0
-    total_bleu_score = 0
-    total_nist_score = 0
+    metrics = CorpusMetrics()
     
     with torch.no_grad():
         for data in val_dataloader:
             input_sentence, input_tensor, target_tensor = data
+            input_tensor = input_tensor.to(device, non_blocking = True)
+            target_tensor = target_tensor.to(device, non_blocking = True)
 
-            encoder_outputs, encoder_hidden = encoder(input_tensor)
-            decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, None) # Do not input the target tensor as this is validation
+            with autocast(precision):
+                input_lengths = (input_tensor != 0).sum(dim = 1)
+                encoder_outputs, encoder_hidden = encoder(input_tensor, lengths = input_lengths)
+                decoder_outputs, _, _ = decoder(encoder_outputs, encoder_hidden, None, max_seq_len = target_tensor.size(1)) # Do not input the target tensor as this is validation
 
-            loss = criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
+                loss = criterion(decoder_outputs.view(-1, decoder_outputs.size(-1)), target_tensor.view(-1))
 
             total_loss += loss.item()
 
-            # Calculate BLEU score
-            bleu_score = calculate_bleu(decoder_outputs, target_tensor)
-            total_bleu_score += bleu_score
+            # Accumulate BLEU and NIST statistics
+            metrics.update(decoder_outputs, target_tensor)
 
-            # Calculate NIST score
-            nist_score = calculate_nist(decoder_outputs, target_tensor)
-            total_nist_score += nist_score
+    return total_loss / len(val_dataloader), metrics.bleu(), metrics.nist()
 
-    return total_loss / len(val_dataloader), total_bleu_score / len(val_dataloader), total_nist_score / len(val_dataloader)
-
-def train(train_dataloader, val_dataloader, model, encoder, decoder, n_epochs, logger, input_lang, output_lang, learning_rate = 0.001, optimizer = "adam", criterion = "negative-log", teacher_forcing_ratio = "none", linear_tf_decay = False, grad_clip = None, self_attention = False):
+def train(train_dataloader, val_dataloader, model, encoder, decoder, n_epochs, logger, input_lang, output_lang, learning_rate = 0.001, optimizer = "adam", criterion = "negative-log", teacher_forcing_ratio = "none", linear_tf_decay = False, grad_clip = None, self_attention = False, metric_every = 1, async_metrics = False, precision = "fp32", accumulation_steps = 1):
     #val_losses = [float("inf")]
     val_bleus = [0]
     counter = 0
@@ -118,6 +152,9 @@ def train(train_dataloader, val_dataloader, model, encoder, decoder, n_epochs, l
         encoder_optimizer = optim.SGD(encoder.parameters(), lr = learning_rate, nesterov = True, momentum = 0.9)
         decoder_optimizer = optim.SGD(decoder.parameters(), lr = learning_rate, nesterov = True, momentum = 0.9)
     
+    # Loss scaling for fp16 training (does nothing otherwise)
+    scaler = grad_scaler(precision)
+
     starting_epoch = 1
 
     if model is not None:
@@ -141,17 +178,17 @@ def train(train_dataloader, val_dataloader, model, encoder, decoder, n_epochs, l
         if (isinstance(teacher_forcing_ratio, int) or isinstance(teacher_forcing_ratio, float)):
             if linear_tf_decay == True:
                 teacher_forcing_ratio = scheduled_sampling(epoch, n_epochs, start_ratio = teacher_forcing_ratio)
-        # Using probabilities so if teacher forcing is not enabled, any number above 1 will disable teacher forcing
+        # Using probabilities so if no ratio is given, any number of 1 or above teacher forces every step (full teacher forcing)
         else:
             teacher_forcing_ratio = 2
         
         # Train and Validation Loss and BLEU score
-        train_loss, train_bleu, train_nist = train_epoch(train_dataloader, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, output_lang, teacher_forcing_ratio = teacher_forcing_ratio, grad_clip = grad_clip, self_attention = self_attention)
-        val_loss, val_bleu, val_nist = validate_epoch(val_dataloader, encoder, decoder, criterion)
+        train_loss, train_bleu, train_nist, data_wait = train_epoch(train_dataloader, encoder, decoder, encoder_optimizer, decoder_optimizer, criterion, output_lang, teacher_forcing_ratio = teacher_forcing_ratio, grad_clip = grad_clip, self_attention = self_attention, metric_every = metric_every, async_metrics = async_metrics, precision = precision, scaler = scaler, accumulation_steps = accumulation_steps)
+        val_loss, val_bleu, val_nist = validate_epoch(val_dataloader, encoder, decoder, criterion, precision = precision)
 
         val_bleus.append(val_bleu)
 
-        print(f"Epoch: {epoch} / {n_epochs}, Train Loss {train_loss}, Validation Loss {val_loss}, Train BLEU {train_bleu}, Validation BLEU {val_bleu}, Train NIST {train_nist}, Validation NIST {val_nist}")
+        print(f"Epoch: {epoch} / {n_epochs}, Train Loss {train_loss}, Validation Loss {val_loss}, Train BLEU {train_bleu}, Validation BLEU {val_bleu}, Train NIST {train_nist}, Validation NIST {val_nist}, Data Wait {data_wait:.1%}")
 
         logger.log({"train_loss": train_loss})
         logger.log({"validation_loss": val_loss})
@@ -160,6 +197,7 @@ def train(train_dataloader, val_dataloader, model, encoder, decoder, n_epochs, l
         logger.log({"train_nist": train_nist})
         logger.log({"validation_nist": val_nist})
         logger.log({"teacher_forcing_ratio": teacher_forcing_ratio})
+        logger.log({"data_wait": data_wait})
 
         if (val_bleu + 0.0001) > val_bleus[-2]:
             # Restart patience (improvement in validation loss)
@@ -225,10 +263,8 @@ def evaluate(encoder, decoder, input_tensor, output_lang):
     EOS_token = 1
     with torch.no_grad():
         encoder_outputs, encoder_hidden = encoder(input_tensor)
-        decoder_outputs, decoder_hidden, decoder_attn = decoder(encoder_outputs, encoder_hidden)
-
-        _, topi = decoder_outputs.topk(1)
-        decoded_ids = topi.squeeze()
+        # Stops decoding once the sentence has produced EOS
+        decoded_ids = decoder.generate(encoder_outputs, encoder_hidden)[0]
 
         decoded_words = []
         for idx in decoded_ids:
@@ -236,7 +272,7 @@ def evaluate(encoder, decoder, input_tensor, output_lang):
                 decoded_words.append("<EOS>")
                 break
             decoded_words.append(output_lang.index2word[idx.item()])
-    return decoded_words, decoder_attn
+    return decoded_words, None
 
 def plot_attention_self(attentions):
     timestamp = int(time.time())
@@ -284,19 +320,43 @@ def main():
     wandb_logger = Logger(logger_settings["logger_name"], project = logger_settings["project_name"])
     logger = wandb_logger.get_logger()
     
-    # Get dataset
-    dataset = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/")
-
-    # Define the sizes for training and validation sets
-    train_size = int(0.8 * len(dataset))
-    val_size = len(dataset) - train_size
-
-    # Split the dataset into training and validation sets
-    train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator = generator)
-
-    # Create data loaders for each set
-    train_dataloader = DataLoader(train_dataset, batch_size = train_settings["batch_size"])
-    val_dataloader = DataLoader(val_dataset, batch_size = train_settings["batch_size"])
+    # Words (or subwords) below min_word_count or outside the max_vocab_size most frequent are mapped to UNK
+    vocab_settings = {"min_count": train_settings["min_word_count"],
+                      "max_vocab_size": train_settings["max_vocab_size"] if isinstance(train_settings["max_vocab_size"], int) else None,
+                      "tokenizer": train_settings["tokenizer"], "bpe_merges": train_settings["bpe_merges"]}
+
+    if train_settings["streaming"] == True:
+        # Pairs are read from the text files on the fly, and every fifth pair is held out for validation
+        dataset = StreamingTranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/", shuffle_buffer = train_settings["shuffle_buffer"], **vocab_settings)
+        train_dataset, val_dataset = dataset.subset("train"), dataset.subset("val")
+    else:
+        # Get dataset
+        cache_dir = None if train_settings["dataset_cache"].lower() == "none" else train_settings["dataset_cache"]
+        dataset = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/", cache_dir = cache_dir, num_workers = train_settings["preprocessing_workers"], **vocab_settings)
+
+        # Define the sizes for training and validation sets
+        train_size = int(0.8 * len(dataset))
+        val_size = len(dataset) - train_size
+
+        # Split the dataset into training and validation sets
+        train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator = generator)
+
+    # Worker processes and pinned memory for the data loaders (prefetching only applies with workers)
+    loader_settings = {"num_workers": train_settings["num_workers"], "pin_memory": train_settings["pin_memory"]}
+    if train_settings["num_workers"] > 0:
+        loader_settings["prefetch_factor"] = train_settings["prefetch_factor"]
+
+    # Create data loaders for each set (a streamed dataset is batched in file order, so it cannot use length bucketing)
+    if train_settings["length_bucketing"] == True and train_settings["streaming"] == False:
+        # Batches of similar-length sentences, padded only to the longest sentence in each batch
+        max_tokens = train_settings["max_tokens"] if isinstance(train_settings["max_tokens"], int) else None
+        train_sampler = BucketBatchSampler([dataset.lengths[i] for i in train_dataset.indices], batch_size = train_settings["batch_size"], max_tokens = max_tokens, generator = generator)
+        val_sampler = BucketBatchSampler([dataset.lengths[i] for i in val_dataset.indices], batch_size = train_settings["batch_size"], max_tokens = max_tokens, shuffle = False)
+        train_dataloader = DataLoader(train_dataset, batch_sampler = train_sampler, collate_fn = collate_batch, **loader_settings)
+        val_dataloader = DataLoader(val_dataset, batch_sampler = val_sampler, collate_fn = collate_batch, **loader_settings)
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded, **loader_settings)
+        val_dataloader = DataLoader(val_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded, **loader_settings)
 
     # Define encoder and decoder
     encoder = EncoderRNN(dataset.input_lang.n_words, model_settings["hidden_dim"], bidirectional = model_settings["encoder_bidirect"], num_layers = model_settings["num_layers_encoder"], layer_norm = model_settings["layer_norm"]).to(device)
@@ -317,7 +377,7 @@ def main():
         self_attention = True
 
     # Training loop
-    train(train_dataloader, val_dataloader, model, encoder, decoder, train_settings["epochs"], logger, dataset.input_lang, dataset.output_lang, learning_rate = train_settings["learning_rate"], optimizer = train_settings["optimizer"], criterion = train_settings["loss_function"], teacher_forcing_ratio = train_settings["teacher_forcing_ratio"], linear_tf_decay = train_settings["linear_tf_decay"], grad_clip = train_settings["grad_clip"], self_attention = self_attention)
+    train(train_dataloader, val_dataloader, model, encoder, decoder, train_settings["epochs"], logger, dataset.input_lang, dataset.output_lang, learning_rate = train_settings["learning_rate"], optimizer = train_settings["optimizer"], criterion = train_settings["loss_function"], teacher_forcing_ratio = train_settings["teacher_forcing_ratio"], linear_tf_decay = train_settings["linear_tf_decay"], grad_clip = train_settings["grad_clip"], self_attention = self_attention, metric_every = train_settings["metric_every"], async_metrics = train_settings["async_metrics"], precision = train_settings["precision"], accumulation_steps = train_settings["accumulation_steps"])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
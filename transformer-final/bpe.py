@@ -0,0 +1,135 @@
+import heapq
+import itertools
+from collections import Counter, defaultdict
+
+# Byte-pair encoding (Sennrich et al., 2016, https://arxiv.org/abs/1508.07909), shared by the seq2seq and Transformer
+# datasets. Merges are learnt from word counts, so the corpus is only read once to count the words.
+#
+# Every subword but the last of a word ends in "@@", e.g. "parliament" -> ["parl@@", "ia@@", "ment"], so a sentence is
+# restored by joining its subwords with spaces and removing "@@ ". While learning and encoding, the end of a word is
+# marked with "</w>" on its last symbol instead, so "ment" at the end of a word and inside one are different symbols.
+
+class BPE:
+    SEPARATOR = "@@"
+    END_OF_WORD = "</w>"
+
+    def __init__(self, merges):
+        self.merges = [tuple(merge) for merge in merges]
+        self.ranks = {merge: rank for rank, merge in enumerate(self.merges)}
+        # word -> subwords, so every distinct word is only segmented once
+        self.cache = {}
+
+    @classmethod
+    def learn(cls, word_counts, num_merges = 10000, min_count = 2):
+        # Greedily merges the most frequent pair of adjacent symbols, num_merges times or until no pair occurs
+        # min_count times. Only the words containing the merged pair are updated, and the pair counts are kept in a
+        # heap whose stale entries are skipped when popped.
+        words = []
+        counts = []
+        for word, count in word_counts:
+            if word:
+                words.append(list(word[:-1]) + [word[-1] + cls.END_OF_WORD])
+                counts.append(count)
+
+        pair_counts = Counter()
+        pair_words = defaultdict(set)
+        for index, symbols in enumerate(words):
+            for pair in zip(symbols, symbols[1:]):
+                pair_counts[pair] += counts[index]
+                pair_words[pair].add(index)
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        merges = []
+        while len(merges) < num_merges and heap:
+            count, pair = heapq.heappop(heap)
+            if -count != pair_counts.get(pair, 0):
+                continue
+            if -count < min_count:
+                break
+            merges.append(pair)
+
+            changed = set()
+            for index in pair_words.pop(pair):
+                symbols = words[index]
+                merged = cls.merge_pair(symbols, pair)
+                if len(merged) == len(symbols):
+                    continue
+                for old_pair in zip(symbols, symbols[1:]):
+                    pair_counts[old_pair] -= counts[index]
+                    changed.add(old_pair)
+                for new_pair in zip(merged, merged[1:]):
+                    pair_counts[new_pair] += counts[index]
+                    pair_words[new_pair].add(index)
+                    changed.add(new_pair)
+                words[index] = merged
+
+            del pair_counts[pair]
+            changed.discard(pair)
+            for changed_pair in changed:
+                if pair_counts[changed_pair] > 0:
+                    heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+                else:
+                    del pair_counts[changed_pair]
+
+        return cls(merges)
+
+    @staticmethod
+    def merge_pair(symbols, pair):
+        # Replaces every occurrence of pair in symbols (left to right) with the merged symbol
+        merged = []
+        i = 0
+        while i < len(symbols):
+            if i + 1 < len(symbols) and symbols[i] == pair[0] and symbols[i + 1] == pair[1]:
+                merged.append(pair[0] + pair[1])
+                i += 2
+            else:
+                merged.append(symbols[i])
+                i += 1
+        return merged
+
+    def encode_word(self, word):
+        subwords = self.cache.get(word)
+        if subwords is not None:
+            return subwords
+        if not word:
+            # An empty sentence (or two spaces in a row), cached as well since encode_batch reads the cache directly
+            self.cache[word] = (word,)
+            return (word,)
+
+        # Apply the learnt merges in the order they were learnt
+        symbols = list(word[:-1]) + [word[-1] + self.END_OF_WORD]
+        while len(symbols) > 1:
+            pair = min(zip(symbols, symbols[1:]), key = lambda pair: self.ranks.get(pair, len(self.ranks)))
+            if pair not in self.ranks:
+                break
+            symbols = self.merge_pair(symbols, pair)
+
+        subwords = tuple([symbol + self.SEPARATOR for symbol in symbols[:-1]] + [symbols[-1][:-len(self.END_OF_WORD)]])
+        self.cache[word] = subwords
+        return subwords
+
+    def encode(self, sentence):
+        return [subword for word in sentence.split(" ") for subword in self.encode_word(word)]
+
+    def encode_batch(self, sentences):
+        # Segments the distinct words of all sentences once, then builds every sentence from the cache
+        sentences = [sentence.split(" ") for sentence in sentences]
+        for word in set(itertools.chain.from_iterable(sentences)).difference(self.cache):
+            self.encode_word(word)
+        cache = self.cache
+        return [[subword for word in words for subword in cache[word]] for words in sentences]
+
+    def decode(self, subwords):
+        sentence = " ".join(subwords).replace(self.SEPARATOR + " ", "")
+        # A sentence cut off in the middle of a word
+        if sentence.endswith(self.SEPARATOR):
+            sentence = sentence[:-len(self.SEPARATOR)]
+        return sentence
+
+    def __getstate__(self):
+        # The cache is rebuilt on use
+        return {"merges": self.merges}
+
+    def __setstate__(self, state):
+        self.__init__(state["merges"])
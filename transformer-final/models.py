@@ -3,6 +3,9 @@ import torch
 import torch.nn.functional as F
 import math
 
+from torch.utils.checkpoint import checkpoint
+from beam_search import beam_search
+
 device = torch.device("cpu")
 if torch.cuda.is_available():
     device = torch.device("cuda")
@@ -23,21 +26,43 @@ class PositionalEmbedding(nn.Module):
         super(PositionalEmbedding, self).__init__()
         
         self.embed_dim = embed_model_dim
-        pe = torch.zeros(max_seq_len, self.embed_dim)
-        for pos in range(max_seq_len):
-            for i in range(0, self.embed_dim, 2):
-                pe[pos, i] = math.sin(pos / (10000 ** ((2 * i) / self.embed_dim)))
-                pe[pos, i + 1] = math.cos(pos / (10000 ** ((2 * (i + 1)) / self.embed_dim)))
-        pe = pe.unsqueeze(0)
-        self.register_buffer("pe", pe)
+        self.max_seq_len = max_seq_len
+        # Sinusoid tables per (device, dtype), built on first use for max_seq_len positions and grown for longer
+        # sequences. They are constants, so they are not saved with the weights
+        self.tables = {}
+
+    @staticmethod
+    def sinusoids(length, embed_dim):
+        # 1 x length x embed_dim, in float64 like the Python floats the table was once filled from element by element
+        position = torch.arange(length, dtype = torch.float64).unsqueeze(1)
+        i = torch.arange(0, embed_dim, 2, dtype = torch.float64)
+        pe = torch.zeros(length, embed_dim, dtype = torch.float64)
+        pe[:, 0::2] = torch.sin(position / (10000 ** ((2 * i) / embed_dim)))
+        pe[:, 1::2] = torch.cos(position / (10000 ** ((2 * (i + 1)) / embed_dim)))[:, :embed_dim // 2]
+        return pe.unsqueeze(0)
+
+    def table(self, seq_len, device, dtype):
+        key = (device, dtype)
+        pe = self.tables.get(key)
+        if pe is None or pe.size(1) < seq_len:
+            # At least double the length when growing, so a slowly growing input does not rebuild it every step
+            length = max(seq_len, self.max_seq_len, 2 * pe.size(1) if pe is not None else 0)
+            pe = self.sinusoids(length, self.embed_dim).to(device = device, dtype = dtype)
+            self.tables[key] = pe
+        return pe[:, :seq_len]
 
     def forward(self, x):
         # Make embeddings relatively larger
         x = x * math.sqrt(self.embed_dim)
         # Add constant to embedding
         seq_len = x.size(1)
-        x = x + torch.autograd.Variable(self.pe[:, :seq_len], requires_grad = False)
+        x = x + self.table(seq_len, x.device, x.dtype)
         return x
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved while the table was a buffer still hold it as "pe"
+        state_dict.pop(prefix + "pe", None)
+        super(PositionalEmbedding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 # As found in https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py
 class RelativePosition(nn.Module):
@@ -49,22 +74,49 @@ class RelativePosition(nn.Module):
         self.embeddings_table = nn.Parameter(torch.zeros(max_relative_position * 2 + 1, num_units, dtype = torch.float32, device = device))
         nn.init.xavier_uniform_(self.embeddings_table)
 
+        # Clipped distances (rows of embeddings_table) for the longest query and key lengths so far, also one-hot
+        # encoded, not saved with the weights
+        self.register_buffer("distances", torch.zeros(0, 0, dtype = torch.long, device = device), persistent = False)
+        self.register_buffer("distances_one_hot", torch.zeros(0, 0, max_relative_position * 2 + 1, device = device), persistent = False)
+
+    def build(self, length):
+        # Built once on the table's device and sliced for every call and layer
+        if length > self.distances.size(0):
+            positions = torch.arange(length, device = self.embeddings_table.device)
+            distance_mat = positions[None, :] - positions[:, None]
+            self.distances = torch.clamp(distance_mat, -self.max_relative_position, self.max_relative_position) + self.max_relative_position
+            self.distances_one_hot = F.one_hot(self.distances, self.max_relative_position * 2 + 1).float()
+
+    def index(self, length_q, length_k, query_start = 0):
+        # Row of embeddings_table for every query and key pair (length_q x length_k), with the queries at positions
+        # query_start onwards
+        self.build(max(query_start + length_q, length_k))
+        return self.distances[query_start:query_start + length_q, :length_k]
+
+    def one_hot(self, length_q, length_k, query_start = 0):
+        # The same as index, one-hot encoded (length_q x length_k x number of embeddings)
+        self.build(max(query_start + length_q, length_k))
+        return self.distances_one_hot[query_start:query_start + length_q, :length_k]
+
     def forward(self, length_q, length_k):
-        range_vec_q = torch.arange(length_q)
-        range_vec_k = torch.arange(length_k)
-        distance_mat = range_vec_k[None, :] - range_vec_q[:, None]
-        distance_mat_clipped = torch.clamp(distance_mat, -self.max_relative_position, self.max_relative_position)
-        final_mat = distance_mat_clipped + self.max_relative_position
-        final_mat = final_mat.clone().detach()
-        embeddings = self.embeddings_table[final_mat]
+        embeddings = self.embeddings_table[self.index(length_q, length_k)]
         return embeddings
 
 ############################### Stage 2 - Multi-head attention ###############################################
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, embed_dim = 512, n_heads = 8):
+    # Attention backends: "math" builds the full score matrix (the reference), "sdpa" dispatches to PyTorch's fused
+    # scaled_dot_product_attention, and "chunked" runs the reference over blocks of chunk_size queries at a time, so only
+    # a chunk_size x key_length block of scores exists at once
+    BACKENDS = ["math", "sdpa", "chunked"]
+
+    def __init__(self, embed_dim = 512, n_heads = 8, backend = "math", chunk_size = 16):
         super(MultiHeadAttention, self).__init__()
 
+        assert backend in self.BACKENDS
+        self.backend = backend
+        self.chunk_size = chunk_size
+
         self.embed_dim = embed_dim  # 512 dim
         self.n_heads = n_heads  # 8
         self.single_head_dim = int(self.embed_dim / self.n_heads)  # 512/8 = 64  . each key,query, value will be of 64d
@@ -75,52 +127,89 @@ class MultiHeadAttention(nn.Module):
         self.value_matrix = nn.Linear(self.single_head_dim, self.single_head_dim, bias = False)
         self.out = nn.Linear(self.n_heads * self.single_head_dim, self.embed_dim)
 
-    def forward(self, key, query, value, mask = None):  # batch_size x sequence_length x embedding_dim    # 32 x 10 x 512
+    def forward(self, key, query, value, mask = None, cache = None):  # batch_size x sequence_length x embedding_dim    # 32 x 10 x 512
         batch_size = key.size(0)
         seq_length = key.size(1)
 
+        # A mask narrower than the keys marks the remaining keys as padding for the whole batch, so they are skipped
+        if mask is not None and mask.size(-1) < seq_length:
+            seq_length = mask.size(-1)
+            key, value = key[:, :seq_length], value[:, :seq_length]
+
         # query dimension can change in decoder during inference.
         # so we cant take general seq_length
         seq_length_query = query.size(1)
 
         # 32x10x512
-        key = key.view(batch_size, seq_length, self.n_heads, self.single_head_dim)  # batch_size x sequence_length x n_heads x single_head_dim = (32x10x8x64)
         query = query.view(batch_size, seq_length_query, self.n_heads, self.single_head_dim)  # (32x10x8x64)
-        value = value.view(batch_size, seq_length, self.n_heads, self.single_head_dim)  # (32x10x8x64)
-
-        k = self.key_matrix(key)  # (32x10x8x64)
         q = self.query_matrix(query)
-        v = self.value_matrix(value)
-
         q = q.transpose(1, 2)  # (batch_size, n_heads, seq_len, single_head_dim)    # (32 x 8 x 10 x 64)
-        k = k.transpose(1, 2)  # (batch_size, n_heads, seq_len, single_head_dim)
-        v = v.transpose(1, 2)  # (batch_size, n_heads, seq_len, single_head_dim)
+
+        # Keys and values come from the encoder output when decoding, so they are projected once and reused at every step
+        if cache is not None and "k" in cache:
+            k, v = cache["k"], cache["v"]
+        else:
+            key = key.view(batch_size, seq_length, self.n_heads, self.single_head_dim)  # batch_size x sequence_length x n_heads x single_head_dim = (32x10x8x64)
+            value = value.view(batch_size, seq_length, self.n_heads, self.single_head_dim)  # (32x10x8x64)
+
+            k = self.key_matrix(key)  # (32x10x8x64)
+            v = self.value_matrix(value)
+
+            k = k.transpose(1, 2)  # (batch_size, n_heads, seq_len, single_head_dim)
+            v = v.transpose(1, 2)  # (batch_size, n_heads, seq_len, single_head_dim)
+
+            if cache is not None:
+                cache["k"], cache["v"] = k, v
 
         # computes attention
+        if self.backend == "sdpa":
+            scores = self.attend_sdpa(q, k, v, mask)
+        elif self.backend == "chunked":
+            scores = self.attend_chunked(q, k, v, mask)
+        else:
+            scores = self.attend(q, k, v, mask)
+
+        # concatenated output
+        concat = scores.transpose(1, 2).contiguous().view(batch_size, seq_length_query, self.single_head_dim * self.n_heads)  # (32x8x10x64) -> (32x10x8x64)  -> (32,10,512)
+
+        output = self.out(concat)  # (32,10,512) -> (32,10,512)
+
+        return output
+
+    def attend(self, q, k, v, mask = None):
         # adjust key for matrix multiplication
         k_adjusted = k.transpose(-1, -2)  # (batch_size, n_heads, single_head_dim, seq_ken)  #(32 x 8 x 64 x 10)
-        product = torch.matmul(q, k_adjusted)  # (32 x 8 x 10 x 64) x (32 x 8 x 64 x 10) = #(32x8x10x10)
+        # In float32 under autocast, as -1e20 does not fit in float16 and the softmax needs the precision
+        product = torch.matmul(q, k_adjusted).float()  # (32 x 8 x 10 x 64) x (32 x 8 x 64 x 10) = #(32x8x10x10)
 
-        # fill those positions of product matrix as (-1e20) where mask positions are 0
+        # fill those positions of product matrix as (-1e20) where the (boolean) mask is False
         if mask is not None:
-            mask = mask.to(device = product.device) 
-            product = product.masked_fill(mask == 0, float("-1e20"))
+            product = product.masked_fill(~mask, float("-1e20"))
 
         # divising by square root of key dimension
         product = product / math.sqrt(self.single_head_dim)  # / sqrt(64)
 
         # applying softmax
-        scores = F.softmax(product, dim = -1)
+        scores = F.softmax(product, dim = -1).to(v.dtype)
 
         # mutiply with value matrix
-        scores = torch.matmul(scores, v)  ##(32x8x 10x 10) x (32 x 8 x 10 x 64) = (32 x 8 x 10 x 64)
-
-        # concatenated output
-        concat = scores.transpose(1, 2).contiguous().view(batch_size, seq_length_query, self.single_head_dim * self.n_heads)  # (32x8x10x64) -> (32x10x8x64)  -> (32,10,512)
-
-        output = self.out(concat)  # (32,10,512) -> (32,10,512)
-
-        return output
+        return torch.matmul(scores, v)  ##(32x8x 10x 10) x (32 x 8 x 10 x 64) = (32 x 8 x 10 x 64)
+
+    def attend_sdpa(self, q, k, v, mask = None):
+        # Scaling, masking, softmax and the product with the values in one kernel. Every query has at least one key it
+        # may attend to (the first source token is never padding), so the boolean mask gives the same result as the
+        # -1e20 fill of the reference
+        return F.scaled_dot_product_attention(q, k, v, attn_mask = mask)
+
+    def attend_chunked(self, q, k, v, mask = None):
+        # The masks are batch_size x 1 x query_length x key_length, or broadcast over the queries with a query length of 1
+        outputs = []
+        for start in range(0, q.size(-2), self.chunk_size):
+            chunk_mask = mask
+            if mask is not None and mask.size(-2) > 1:
+                chunk_mask = mask[..., start:start + self.chunk_size, :]
+            outputs.append(self.attend(q[..., start:start + self.chunk_size, :], k, v, chunk_mask))
+        return torch.cat(outputs, dim = -2)
 
 # As found in https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py
 class MultiHeadAttentionRelativePosition(nn.Module):
@@ -147,42 +236,59 @@ class MultiHeadAttentionRelativePosition(nn.Module):
         
         self.scale = torch.sqrt(torch.tensor([self.head_dim], dtype = torch.float32, device = device))
         
-    def forward(self, key, query, value, mask = None):
+    def forward(self, key, query, value, mask = None, cache = None):
         #query = [batch size, query len, hid dim]
         #key = [batch size, key len, hid dim]
         #value = [batch size, value len, hid dim]
+
+        # A mask narrower than the keys marks the remaining keys as padding for the whole batch, so they are skipped
+        if mask is not None and mask.size(-1) < key.shape[1]:
+            key, value = key[:, :mask.size(-1)], value[:, :mask.size(-1)]
+
         batch_size = query.shape[0]
         len_k = key.shape[1]
         len_q = query.shape[1]
         len_v = value.shape[1]
 
         query = self.fc_q(query)
-        key = self.fc_k(key)
-        value = self.fc_v(value)
+
+        # Keys and values come from the encoder output when decoding, so they are projected once and reused at every step
+        if cache is not None and "k" in cache:
+            key, value = cache["k"], cache["v"]
+        else:
+            key = self.fc_k(key)
+            value = self.fc_v(value)
+
+            if cache is not None:
+                cache["k"], cache["v"] = key, value
 
         r_q1 = query.view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
         r_k1 = key.view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
         attn1 = torch.matmul(r_q1, r_k1.permute(0, 1, 3, 2)) 
 
-        r_q2 = query.permute(1, 0, 2).contiguous().view(len_q, batch_size*self.n_heads, self.head_dim)
-        r_k2 = self.relative_position_k(len_q, len_k)
-        attn2 = torch.matmul(r_q2, r_k2.transpose(1, 2)).transpose(0, 1)
-        attn2 = attn2.contiguous().view(batch_size, self.n_heads, len_q, len_k)
-        attn = (attn1 + attn2) / self.scale
+        # While decoding, the queries may only be the last rows of the full pass, starting at position query_start
+        query_start = cache.get("query_start", 0) if cache is not None else 0
+
+        # The relative positions only take 2 * max_relative_position + 1 values, so every query is scored against each
+        # relative position embedding once, and every key then takes the score of its clipped distance
+        attn2 = torch.matmul(r_q1, self.relative_position_k.embeddings_table.t())
+        one_hot = self.relative_position_k.one_hot(len_q, len_k, query_start).to(attn2.dtype)
+        attn2 = torch.einsum("bhqr,qkr->bhqk", attn2, one_hot)
+        # In float32 under autocast, as -1e20 does not fit in float16 and the softmax needs the precision
+        attn = (attn1 + attn2).float() / self.scale
 
         if mask is not None:
-            mask = mask.to(device = attn.device) 
-            attn = attn.masked_fill(mask == 0, float("-1e20"))
+            attn = attn.masked_fill(~mask, float("-1e20"))
 
-        attn = self.dropout(torch.softmax(attn, dim = -1))
+        attn = self.dropout(torch.softmax(attn, dim = -1)).to(value.dtype)
 
         #attn = [batch size, n heads, query len, key len]
         r_v1 = value.view(batch_size, -1, self.n_heads, self.head_dim).permute(0, 2, 1, 3)
         weight1 = torch.matmul(attn, r_v1)
-        r_v2 = self.relative_position_v(len_q, len_v)
-        weight2 = attn.permute(2, 0, 1, 3).contiguous().view(len_q, batch_size*self.n_heads, len_k)
-        weight2 = torch.matmul(weight2, r_v2)
-        weight2 = weight2.transpose(0, 1).contiguous().view(batch_size, self.n_heads, len_q, self.head_dim)
+        # Likewise, the attention weights of all keys at the same clipped distance are summed, and weight the relative
+        # position embeddings of the values
+        weight2 = torch.einsum("bhqk,qkr->bhqr", attn, one_hot.to(attn.dtype))
+        weight2 = torch.matmul(weight2, self.relative_position_v.embeddings_table)
 
         x = weight1 + weight2
         
@@ -203,13 +309,14 @@ class MultiHeadAttentionRelativePosition(nn.Module):
         return x
 
 class TransformerBlock(nn.Module):
-    def __init__(self, embed_dim, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False):
+    def __init__(self, embed_dim, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False, attention_backend = "math"):
         super(TransformerBlock, self).__init__()
         
+        # Relative attention adds position terms to the scores and the weighted values, so it always uses its own math
         if relative_attention == True:
             self.attention = MultiHeadAttentionRelativePosition(embed_dim, n_heads, 0)
         else:
-            self.attention = MultiHeadAttention(embed_dim, n_heads)
+            self.attention = MultiHeadAttention(embed_dim, n_heads, backend = attention_backend)
 
         self.norm1 = nn.LayerNorm(embed_dim)
         self.norm2 = nn.LayerNorm(embed_dim)
@@ -223,11 +330,13 @@ class TransformerBlock(nn.Module):
         self.dropout1 = nn.Dropout(0.2)
         self.dropout2 = nn.Dropout(0.2)
 
-    def forward(self, key, query, value):
+    def forward(self, key, query, value, mask = None, cache = None):
+        # While decoding only the final position is read, so the residual stream is cut down to it
+        residual = value if cache is None else value[:, -1:]
 
         if self.norm_first == True:
-            attention_out = self.attention(key, query, self.norm1(value))  # 32x10x512
-            attention_residual_out = attention_out + value  # 32x10x512
+            attention_out = self.attention(key, query, self.norm1(value), mask = mask, cache = cache)  # 32x10x512
+            attention_residual_out = attention_out + residual  # 32x10x512
             norm1_out = self.dropout1(attention_residual_out)  # 32x10x512
 
             feed_fwd_out = self.feed_forward(self.norm2(norm1_out))  # 32x10x512 -> #32x10x2048 -> 32x10x512
@@ -235,8 +344,8 @@ class TransformerBlock(nn.Module):
             norm2_out = self.dropout2(feed_fwd_residual_out)  # 32x10x512
 
         else:
-            attention_out = self.attention(key, query, value)  # 32x10x512
-            attention_residual_out = attention_out + value  # 32x10x512
+            attention_out = self.attention(key, query, value, mask = mask, cache = cache)  # 32x10x512
+            attention_residual_out = attention_out + residual  # 32x10x512
             norm1_out = self.dropout1(self.norm1(attention_residual_out))  # 32x10x512
 
             feed_fwd_out = self.feed_forward(norm1_out)  # 32x10x512 -> #32x10x2048 -> 32x10x512
@@ -246,30 +355,30 @@ class TransformerBlock(nn.Module):
         return norm2_out
 
 class TransformerEncoder(nn.Module):
-    def __init__(self, seq_len, vocab_size, embed_dim, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False):
+    def __init__(self, seq_len, vocab_size, embed_dim, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False, attention_backend = "math"):
         super(TransformerEncoder, self).__init__()
 
         self.embedding_layer = Embedding(vocab_size, embed_dim)
         self.positional_encoder = PositionalEmbedding(seq_len, embed_dim)
 
-        self.layers = nn.ModuleList([TransformerBlock(embed_dim = embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention) for i in range(num_layers)])
+        self.layers = nn.ModuleList([TransformerBlock(embed_dim = embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention, attention_backend = attention_backend) for i in range(num_layers)])
 
-    def forward(self, x):
+    def forward(self, x, mask = None):
         embed_out = self.embedding_layer(x)
         out = self.positional_encoder(embed_out)
         for layer in self.layers:
-            out = layer(out, out, out)
+            out = layer(out, out, out, mask = mask)
 
         return out  # 32x10x512
 
 class DecoderBlock(nn.Module):
-    def __init__(self, embed_dim, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False):
+    def __init__(self, embed_dim, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False, attention_backend = "math"):
         super(DecoderBlock, self).__init__()
 
         if relative_attention == True:
             self.attention = MultiHeadAttentionRelativePosition(embed_dim, n_heads, 0)
         else:
-            self.attention = MultiHeadAttention(embed_dim, n_heads)
+            self.attention = MultiHeadAttention(embed_dim, n_heads, backend = attention_backend)
 
         self.norm = nn.LayerNorm(embed_dim)
         if norm_first == True:
@@ -277,71 +386,157 @@ class DecoderBlock(nn.Module):
             self.norm3 = nn.LayerNorm(embed_dim)
         self.norm_first = norm_first
         self.dropout = nn.Dropout(0.2)
-        self.transformer_block = TransformerBlock(embed_dim = embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention)
+        self.transformer_block = TransformerBlock(embed_dim = embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention, attention_backend = attention_backend)
 
-    def forward(self, key, query, x, mask):
-        if self.norm_first == True:
-            # We need to pass mask only to first attention
+    def forward(self, key, query, x, mask, src_mask = None, cache = None):
+        # The masked attention only sees the encoder output, so while decoding it is computed once per sentence
+        if cache is not None and "value" in cache:
+            value = cache["value"]
+
+        elif self.norm_first == True:
+            # Target mask for the first attention, source padding mask for the second
             attention = self.attention(self.norm(x), self.norm2(x), self.norm3(x), mask = mask)  # 32x10x512
             value = self.dropout(attention + x)
 
         else:
-            # We need to pass mask only to first attention
+            # Target mask for the first attention, source padding mask for the second
             attention = self.attention(x, x, x, mask = mask)  # 32x10x512
             value = self.dropout(self.norm(attention + x))
 
-        out = self.transformer_block(key, query, value)
+        if cache is not None:
+            cache["value"] = value
+
+        out = self.transformer_block(key, query, value, mask = src_mask, cache = cache)
 
         return out
 
 class TransformerDecoder(nn.Module):
-    def __init__(self, target_vocab_size, embed_dim, seq_len, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False):
+    def __init__(self, target_vocab_size, embed_dim, seq_len, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False, attention_backend = "math"):
         super(TransformerDecoder, self).__init__()
 
         self.word_embedding = nn.Embedding(target_vocab_size, embed_dim)
         self.position_embedding = PositionalEmbedding(seq_len, embed_dim)
 
-        self.layers = nn.ModuleList([DecoderBlock(embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention) for _ in range(num_layers)])
+        self.layers = nn.ModuleList([DecoderBlock(embed_dim, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention, attention_backend = attention_backend) for _ in range(num_layers)])
         self.fc_out = nn.Linear(embed_dim, target_vocab_size)
         self.dropout = nn.Dropout(0.2)
 
-    def forward(self, x, enc_out, mask):
+    def forward(self, x, enc_out, mask, src_mask = None, cache = None, output = "logits"):
+        # output is "logits" (for training, the loss applies its own log-softmax), "log_probs" (for inference), or
+        # "hidden", the last layer's output before fc_out, for chunked_cross_entropy
 
         x = self.word_embedding(x)  # 32x10x512
         x = self.position_embedding(x)  # 32x10x512
         x = self.dropout(x)
 
-        for layer in self.layers:
-            x = layer(enc_out, x, enc_out, mask)
+        # The masked attention runs over the encoder output, so source padding is masked out of it as well (once for
+        # every layer)
+        if src_mask is not None:
+            mask = mask[..., :src_mask.size(-1)] & src_mask
+
+        for i, layer in enumerate(self.layers):
+            # In the full pass, every layer after the first has a row for each source position (the residual stream of
+            # the encoder side). While decoding only the last rows are kept, and relative attention needs their positions
+            if cache is not None and i > 0:
+                cache[i]["query_start"] = max(enc_out.size(1) - x.size(1), 0)
+            x = layer(enc_out, x, enc_out, mask, src_mask = src_mask, cache = (cache[i] if cache is not None else None))
+
+        if output == "hidden":
+            return x
 
-        out = F.softmax(self.fc_out(x))
+        # The output scores (and so the loss) are always float32, also under autocast
+        out = self.fc_out(x).float()
+        if output == "log_probs":
+            out = F.log_softmax(out, dim = -1)
 
         return out
 
+def chunked_cross_entropy(hidden, output_layer, target, ignore_index = -100, label_smoothing = 0, chunk_size = 1024):
+    # Cross-entropy of output_layer(hidden) against target, averaged over the positions that are not ignore_index as
+    # nn.CrossEntropyLoss does, and the predicted ids (shaped like target). The logits are built chunk_size positions at
+    # a time and are not kept for the backward pass, which recomputes them chunk by chunk (activation checkpointing),
+    # so at most chunk_size x vocab_size logits exist at once instead of batch_size x seq_len x vocab_size
+    def chunk_loss(hidden, target):
+        logits = output_layer(hidden).float()
+        loss = F.cross_entropy(logits, target, ignore_index = ignore_index, label_smoothing = label_smoothing, reduction = "sum")
+        return loss, logits.argmax(dim = -1)
+
+    flat_hidden = hidden.reshape(-1, hidden.size(-1))
+    flat_target = target.reshape(-1)
+
+    total_loss = 0
+    predicted = []
+    for start in range(0, flat_target.size(0), chunk_size):
+        chunk = (flat_hidden[start:start + chunk_size], flat_target[start:start + chunk_size])
+        if torch.is_grad_enabled():
+            loss, chunk_predicted = checkpoint(chunk_loss, *chunk, use_reentrant = False)
+        else:
+            loss, chunk_predicted = chunk_loss(*chunk)
+        total_loss = total_loss + loss
+        predicted.append(chunk_predicted)
+
+    n_tokens = (flat_target != ignore_index).sum()
+    return total_loss / n_tokens, torch.cat(predicted).view_as(target)
+
 class Transformer(nn.Module):
-    def __init__(self, embed_dim, src_vocab_size, target_vocab_size, seq_len, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False):
+    SOS_token = 0
+    EOS_token = 1
+
+    def __init__(self, embed_dim, src_vocab_size, target_vocab_size, seq_len, num_layers = 2, expansion_factor = 4, n_heads = 8, activation = "ReLU", norm_first = False, relative_attention = False, skip_padded_keys = False, key_block_size = 8, attention_backend = "math"):
         super(Transformer, self).__init__()
 
         self.target_vocab_size = target_vocab_size
+        self.relative_attention = relative_attention
+        self.skip_padded_keys = skip_padded_keys
+        self.key_block_size = key_block_size
 
-        self.encoder = TransformerEncoder(seq_len = seq_len, vocab_size = src_vocab_size, embed_dim = embed_dim, num_layers = num_layers, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention)
-        self.decoder = TransformerDecoder(target_vocab_size = target_vocab_size, embed_dim = embed_dim, seq_len = seq_len, num_layers = num_layers, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention)
+        # Causal mask for the longest target so far, on the model's device, sliced for every batch and decoding step.
+        # Not saved with the weights, so checkpoints are unchanged
+        self.register_buffer("causal_mask", torch.tril(torch.ones(seq_len, seq_len, dtype = torch.bool)), persistent = False)
 
-    def make_trg_mask(self, trg):
-        batch_size, trg_len = trg.shape
-        # Returns the lower triangular part of matrix filled with ones
-        trg_mask = torch.tril(torch.ones((trg_len, trg_len))).expand(batch_size, 1, trg_len, trg_len)
-        return trg_mask
+        self.encoder = TransformerEncoder(seq_len = seq_len, vocab_size = src_vocab_size, embed_dim = embed_dim, num_layers = num_layers, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention, attention_backend = attention_backend)
+        self.decoder = TransformerDecoder(target_vocab_size = target_vocab_size, embed_dim = embed_dim, seq_len = seq_len, num_layers = num_layers, expansion_factor = expansion_factor, n_heads = n_heads, activation = activation, norm_first = norm_first, relative_attention = relative_attention, attention_backend = attention_backend)
 
-    def decode(self, src, trg):
+    def make_trg_mask(self, trg):
+        trg_len = trg.shape[1]
+        # Only grows for targets longer than seq_len
+        if trg_len > self.causal_mask.size(0):
+            self.causal_mask = torch.tril(torch.ones(trg_len, trg_len, dtype = torch.bool, device = self.causal_mask.device))
+        # The lower triangular part is True, 1 x 1 x trg_len x trg_len so it broadcasts over the batch and heads
+        return self.causal_mask[:trg_len, :trg_len].view(1, 1, trg_len, trg_len)
+
+    def make_src_mask(self, src):
+        # True for real tokens and False for padding (index 0), batch_size x 1 x 1 x src_len
+        src_mask = (src != 0).unsqueeze(1).unsqueeze(2)
+
+        # Blocks of keys that are padding in every sentence of the batch are cut from the mask, and attention then skips them
+        if self.skip_padded_keys == True:
+            n_keys = (src != 0).sum(dim = 1).max().item()
+            n_keys = min(math.ceil(n_keys / self.key_block_size) * self.key_block_size, src.size(1))
+            src_mask = src_mask[..., :n_keys]
+
+        return src_mask
+
+    def init_cache(self):
+        # One dictionary per decoder layer, filled with encoder-side tensors on the first decoding step
+        return [{} for _ in self.decoder.layers]
+
+    def decode(self, src, trg, use_cache = True):
         trg_mask = self.make_trg_mask(trg)
-        enc_out = self.encoder(src)
+        src_mask = self.make_src_mask(src)
+        enc_out = self.encoder(src, src_mask)
         out_labels = []
         batch_size, seq_len = src.shape[0], src.shape[1]
         # outputs = torch.zeros(seq_len, batch_size, self.target_vocab_size)
+
+        # Incremental decoding only processes the newest token at each step
+        cache = None
+        if use_cache == True:
+            cache = self.init_cache()
+
         out = trg
         for i in range(seq_len):  # 10
-            out = self.decoder(out, enc_out, trg_mask)  # bs x seq_len x vocab_dim
+            out = self.decoder(out, enc_out, trg_mask, src_mask, cache = cache)  # bs x seq_len x vocab_dim
             # taking the last token
             out = out[:, -1, :]
 
@@ -351,9 +546,64 @@ class Transformer(nn.Module):
 
         return out_labels
 
-    def forward(self, src, trg):
+    def translate_batch(self, src, max_len = None):
+        # Greedy decoding for a whole batch of (padded) source sentences, returns a batch_size x steps tensor of token ids
+        batch_size = src.shape[0]
+        if max_len is None:
+            max_len = src.shape[1]
+
+        trg = torch.full((batch_size, 1), self.SOS_token, dtype = torch.long, device = src.device)
+        trg_mask = self.make_trg_mask(trg)
+        src_mask = self.make_src_mask(src)
+        enc_out = self.encoder(src, src_mask)
+
+        cache = self.init_cache()
+
+        finished = torch.zeros(batch_size, dtype = torch.bool, device = src.device)
+        out_labels = []
+        out = trg
+        for i in range(max_len):
+            out = self.decoder(out, enc_out, trg_mask, src_mask, cache = cache)
+            out = out[:, -1, :].argmax(-1)
+
+            # Sentences that already produced EOS are padded, as in the dataset targets
+            out = out.masked_fill(finished, self.SOS_token)
+            out_labels.append(out)
+
+            # Stop as soon as every sentence in the batch has finished
+            finished = finished | (out == self.EOS_token)
+            if finished.all():
+                break
+
+            out = out.unsqueeze(1)
+
+        return torch.stack(out_labels, dim = 1)
+
+    def beam_search(self, src, beam_size = 4, max_len = None, n_best = 1, alpha = 0.6):
+        # Returns the n best hypotheses per source sentence (batch_size x n_best x steps) and their scores
+        batch_size = src.shape[0]
+        if max_len is None:
+            max_len = src.shape[1]
+
+        src_mask = self.make_src_mask(src)
+        enc_out = self.encoder(src, src_mask).repeat_interleave(beam_size, dim = 0)
+        src_mask = src_mask.repeat_interleave(beam_size, dim = 0)
+        trg_mask = self.make_trg_mask(torch.zeros(batch_size * beam_size, 1))
+
+        cache = self.init_cache()
+
+        def step(decoder_input, cache):
+            out = self.decoder(decoder_input, enc_out, trg_mask, src_mask, cache = cache, output = "log_probs")
+            return out[:, -1, :], cache
+
+        # The cache only holds encoder-side tensors, which are shared by all beams of a sentence, so it never needs reordering
+        return beam_search(step, cache, batch_size, src.device, beam_size = beam_size, max_len = max_len, n_best = n_best, alpha = alpha, SOS_token = self.SOS_token, EOS_token = self.EOS_token)
+
+    def forward(self, src, trg, output = "logits"):
+        # Both masks are built once per batch and shared by every layer
         trg_mask = self.make_trg_mask(trg)
-        enc_out = self.encoder(src)
+        src_mask = self.make_src_mask(src)
+        enc_out = self.encoder(src, src_mask)
 
-        outputs = self.decoder(trg, enc_out, trg_mask)
+        outputs = self.decoder(trg, enc_out, trg_mask, src_mask, output = output)
         return outputs
\ No newline at end of file
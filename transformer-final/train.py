@@ -1,78 +1,120 @@
 import os
+import time
+import itertools
 import torch
 import torch.optim as optim
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from models import Transformer
-from dataset import TranslationDataset
+from models import Transformer, chunked_cross_entropy
+from dataset import TranslationDataset, StreamingTranslationDataset, BucketBatchSampler, collate_batch, collate_padded
 from logger import Logger
 
 import numpy as np
 import random
 
 from torch.utils.data import DataLoader, random_split
-from utils import parse_arguments, read_settings, calculate_bleu, calculate_nist
+from utils import parse_arguments, read_settings, CorpusMetrics, make_metrics, autocast, grad_scaler
 
 device = torch.device("cpu")
 if torch.cuda.is_available():
     device = torch.device("cuda")
 
-def train_epoch(train_dataloader, model, optimizer, criterion, use_gradient_clipping):
+def compute_loss(model, src, target_tensor, criterion, loss_chunk_size = None):
+    # Returns the loss and what the metrics are computed from: the scores, or the predicted ids with loss_chunk_size,
+    # where the output layer and the cross-entropy run chunk by chunk without building all the logits at once
+    if loss_chunk_size is None:
+        # The model returns logits, which nn.NLLLoss needs as log-probabilities
+        output = model(src, target_tensor, output = "log_probs" if isinstance(criterion, nn.NLLLoss) else "logits")
+        return criterion(output.view(-1, output.size(-1)), target_tensor.view(-1)), output
+
+    # The cross-entropy of the logits is the negative log-likelihood of their log-softmax, so this serves both losses
+    hidden = model(src, target_tensor, output = "hidden")
+    return chunked_cross_entropy(hidden, model.decoder.fc_out, target_tensor, ignore_index = criterion.ignore_index, label_smoothing = getattr(criterion, "label_smoothing", 0), chunk_size = loss_chunk_size)
+
+def train_epoch(train_dataloader, model, optimizer, criterion, use_gradient_clipping, metric_every = 1, async_metrics = False, precision = "fp32", scaler = None, accumulation_steps = 1, loss_chunk_size = None):
     model.train()
     total_loss = 0
-    total_bleu_score = 0
-    total_nist_score = 0
+    # Corpus BLEU and NIST over every metric_every-th batch of the epoch, computed on the device with only occasional
+    # syncs (when the n-gram counts are merged), or in a background thread with async_metrics
+    metrics = make_metrics(async_metrics)
+
+    # Time spent waiting for the next batch, reported as a share of the epoch
+    data_time = 0
+    epoch_start = time.perf_counter()
+    data_start = epoch_start
+
+    # Every optimiser step accumulates the gradients of accumulation_steps batches (micro-batches)
+    batches = iter(train_dataloader)
+    batch_index = 0
+
+    while True:
+        group = list(itertools.islice(batches, accumulation_steps))
+        data_time += time.perf_counter() - data_start
+        if len(group) == 0:
+            break
+
+        # Target tokens the loss of each micro-batch is averaged over (padding is ignored). Each loss is weighted by its
+        # share of the tokens of the group, so the step averages over tokens as one batch holding all of them would
+        tokens = [(target_tensor != criterion.ignore_index).sum().item() for _, _, target_tensor in group]
+        group_tokens = sum(tokens)
 
-    for _, src, target_tensor in train_dataloader:
         optimizer.zero_grad()
 
-        # Forward pass
-        output = model(src, target_tensor)
-        loss = criterion(output.view(-1, output.size(-1)), target_tensor.view(-1))
+        for (_, src, target_tensor), micro_tokens in zip(group, tokens):
+            # Batches come from the DataLoader on the CPU, pinned batches are copied to the GPU asynchronously
+            src = src.to(device, non_blocking = True)
+            target_tensor = target_tensor.to(device, non_blocking = True)
 
-        # Backward pass and optimisation
-        loss.backward()
-        
+            # Forward pass (in reduced precision with bf16/fp16, the output and loss stay float32)
+            with autocast(precision):
+                loss, output = compute_loss(model, src, target_tensor, criterion, loss_chunk_size)
+
+            # Backward pass, through the gradient scaler for fp16
+            scaler.scale(loss * (micro_tokens / group_tokens)).backward()
+
+            total_loss += loss.item()
+
+            # Accumulate BLEU and NIST statistics
+            if batch_index % metric_every == 0:
+                metrics.update(output.detach(), target_tensor)
+            batch_index += 1
+
+        # Optimisation
         if use_gradient_clipping == True:
+            # Clip the true gradients, not the scaled ones
+            scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm = 1)
             
-        optimizer.step()
-
-        total_loss += loss.item()
+        # Skipped if the fp16 gradients overflowed, the scale is then lowered for the next step
+        scaler.step(optimizer)
+        scaler.update()
 
-        # Calculate BLEU score
-        bleu_score = calculate_bleu(output, target_tensor)
-        total_bleu_score += bleu_score
+        data_start = time.perf_counter()
 
-        # Calculate NIST score
-        nist_score = calculate_nist(output, target_tensor)
-        total_nist_score += nist_score
+    data_wait = data_time / (time.perf_counter() - epoch_start)
 
-    return total_loss / len(train_dataloader), total_bleu_score / len(train_dataloader), total_nist_score / len(train_dataloader)
+    return total_loss / len(train_dataloader), metrics.bleu(), metrics.nist(), data_wait
 
-def validate_epoch(val_dataloader, model, criterion):
+def validate_epoch(val_dataloader, model, criterion, precision = "fp32", loss_chunk_size = None):
     model.eval()
     total_loss = 0
-    total_bleu_score = 0
-    total_nist_score = 0
+    metrics = CorpusMetrics()
     
     with torch.no_grad():
         for _, src, target_tensor in val_dataloader:
-            output = model(src, target_tensor)
-            loss = criterion(output.view(-1, output.size(-1)), target_tensor.view(-1))
-            total_loss += loss.item()
+            src = src.to(device, non_blocking = True)
+            target_tensor = target_tensor.to(device, non_blocking = True)
 
-             # Calculate BLEU score
-            bleu_score = calculate_bleu(output, target_tensor)
-            total_bleu_score += bleu_score
+            with autocast(precision):
+                loss, output = compute_loss(model, src, target_tensor, criterion, loss_chunk_size)
+            total_loss += loss.item()
 
-            # Calculate NIST score
-            nist_score = calculate_nist(output, target_tensor)
-            total_nist_score += nist_score
+            # Accumulate BLEU and NIST statistics
+            metrics.update(output, target_tensor)
 
-    return total_loss / len(val_dataloader), total_bleu_score / len(val_dataloader), total_nist_score / len(val_dataloader)
+    return total_loss / len(val_dataloader), metrics.bleu(), metrics.nist()
 
-def train(train_dataloader, val_dataloader, model, n_epochs, use_gradient_clipping, logger, learning_rate = 0.0001, optimizer = "adam", criterion = "cross-entropy", label_smoothing = 0, checkpoint = None):
+def train(train_dataloader, val_dataloader, model, n_epochs, use_gradient_clipping, logger, learning_rate = 0.0001, optimizer = "adam", criterion = "cross-entropy", label_smoothing = 0, checkpoint = None, metric_every = 1, async_metrics = False, precision = "fp32", accumulation_steps = 1, loss_chunk_size = None):
     val_bleus = [0]
     counter = 0
     
@@ -90,6 +132,9 @@ def train(train_dataloader, val_dataloader, model, n_epochs, use_gradient_clippi
     elif criterion == "negative-log":
         criterion = nn.NLLLoss(ignore_index = 0)
 
+    # Loss scaling for fp16 training (does nothing otherwise)
+    scaler = grad_scaler(precision)
+
     starting_epoch = 1
 
     # Choose correct starting epoch and set correct parameters for optimiser, only if checkpoint is available
@@ -98,15 +143,16 @@ def train(train_dataloader, val_dataloader, model, n_epochs, use_gradient_clippi
         optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
 
     for epoch in range(starting_epoch, n_epochs + 1):
-        train_loss, train_bleu, train_nist = train_epoch(train_dataloader, model, optimizer, criterion, use_gradient_clipping)
-        val_loss, val_bleu, val_nist = validate_epoch(val_dataloader, model, criterion)
+        train_loss, train_bleu, train_nist, data_wait = train_epoch(train_dataloader, model, optimizer, criterion, use_gradient_clipping, metric_every = metric_every, async_metrics = async_metrics, precision = precision, scaler = scaler, accumulation_steps = accumulation_steps, loss_chunk_size = loss_chunk_size)
+        val_loss, val_bleu, val_nist = validate_epoch(val_dataloader, model, criterion, precision = precision, loss_chunk_size = loss_chunk_size)
 
         val_bleus.append(val_bleu)
 
         logger.log({"train_loss": train_loss, "val_loss": val_loss})
         logger.log({"train_bleu": train_bleu, "val_bleu": val_bleu})
         logger.log({"train_nist": train_nist, "val_nist": val_nist})
-        print(f"Epoch: {epoch} / {n_epochs}, Train Loss {train_loss}, Validation Loss {val_loss}, Train BLEU {train_bleu}, Validation BLEU {val_bleu}, Train NIST {train_nist}, Validation NIST {val_nist}")
+        logger.log({"data_wait": data_wait})
+        print(f"Epoch: {epoch} / {n_epochs}, Train Loss {train_loss}, Validation Loss {val_loss}, Train BLEU {train_bleu}, Validation BLEU {val_bleu}, Train NIST {train_nist}, Validation NIST {val_nist}, Data Wait {data_wait:.1%}")
 
         if (val_bleu + 0.0001) > val_bleus[-2]:
             # Restart patience (improvement in validation loss)
@@ -188,19 +234,43 @@ def main():
     wandb_logger = Logger(logger_settings["logger_name"], project = logger_settings["project_name"])
     logger = wandb_logger.get_logger()
     
-    # Load the dataset and create DataLoader
-    dataset = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/")
-
-    # Define the sizes for training and validation sets
-    train_size = int(0.8 * len(dataset))
-    val_size = len(dataset) - train_size
-    
-    # Split the dataset into training and validation sets
-    train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator = generator)
-
-    # Create data loaders for each set
-    train_dataloader = DataLoader(train_dataset, batch_size = train_settings["batch_size"])
-    val_dataloader = DataLoader(val_dataset, batch_size = train_settings["batch_size"])
+    # Words (or subwords) below min_word_count or outside the max_vocab_size most frequent are mapped to UNK
+    vocab_settings = {"min_count": train_settings["min_word_count"],
+                      "max_vocab_size": train_settings["max_vocab_size"] if isinstance(train_settings["max_vocab_size"], int) else None,
+                      "tokenizer": train_settings["tokenizer"], "bpe_merges": train_settings["bpe_merges"]}
+
+    if train_settings["streaming"] == True:
+        # Pairs are read from the text files on the fly, and every fifth pair is held out for validation
+        dataset = StreamingTranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/", shuffle_buffer = train_settings["shuffle_buffer"], **vocab_settings)
+        train_dataset, val_dataset = dataset.subset("train"), dataset.subset("val")
+    else:
+        # Load the dataset
+        cache_dir = None if train_settings["dataset_cache"].lower() == "none" else train_settings["dataset_cache"]
+        dataset = TranslationDataset(lang1 = "europarl-v7.fr-en.en", lang2 = "europarl-v7.fr-en.fr", max_seq_len = model_settings["max_seq_length"], reverse = False, directory = "../fr-en/", cache_dir = cache_dir, num_workers = train_settings["preprocessing_workers"], **vocab_settings)
+
+        # Define the sizes for training and validation sets
+        train_size = int(0.8 * len(dataset))
+        val_size = len(dataset) - train_size
+
+        # Split the dataset into training and validation sets
+        train_dataset, val_dataset = random_split(dataset, [train_size, val_size], generator = generator)
+
+    # Worker processes and pinned memory for the data loaders (prefetching only applies with workers)
+    loader_settings = {"num_workers": train_settings["num_workers"], "pin_memory": train_settings["pin_memory"]}
+    if train_settings["num_workers"] > 0:
+        loader_settings["prefetch_factor"] = train_settings["prefetch_factor"]
+
+    # Create data loaders for each set (a streamed dataset is batched in file order, so it cannot use length bucketing)
+    if train_settings["length_bucketing"] == True and train_settings["streaming"] == False:
+        # Batches of similar-length sentences, padded only to the longest sentence in each batch
+        max_tokens = train_settings["max_tokens"] if isinstance(train_settings["max_tokens"], int) else None
+        train_sampler = BucketBatchSampler([dataset.lengths[i] for i in train_dataset.indices], batch_size = train_settings["batch_size"], max_tokens = max_tokens, generator = generator)
+        val_sampler = BucketBatchSampler([dataset.lengths[i] for i in val_dataset.indices], batch_size = train_settings["batch_size"], max_tokens = max_tokens, shuffle = False)
+        train_dataloader = DataLoader(train_dataset, batch_sampler = train_sampler, collate_fn = collate_batch, **loader_settings)
+        val_dataloader = DataLoader(val_dataset, batch_sampler = val_sampler, collate_fn = collate_batch, **loader_settings)
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded, **loader_settings)
+        val_dataloader = DataLoader(val_dataset, batch_size = train_settings["batch_size"], collate_fn = collate_padded, **loader_settings)
 
     # Create the Transformer model
     src_vocab_size = dataset.input_lang.n_words
@@ -209,7 +279,7 @@ def main():
     model = Transformer(embed_dim = model_settings["hidden_size"], src_vocab_size = src_vocab_size,
                         target_vocab_size = target_vocab_size, seq_len = model_settings["max_seq_length"],
                         num_layers = model_settings["num_layers"], expansion_factor = model_settings["expansion_factor"],
-                        n_heads = model_settings["n_heads"], activation = model_settings["activation"], norm_first = model_settings["norm_first"], relative_attention = model_settings["relative_attention"]).to(device)
+                        n_heads = model_settings["n_heads"], activation = model_settings["activation"], norm_first = model_settings["norm_first"], relative_attention = model_settings["relative_attention"], skip_padded_keys = model_settings["skip_padded_keys"], attention_backend = model_settings["attention_backend"]).to(device)
 
     checkpoint = None
 
@@ -225,7 +295,7 @@ def main():
         model.load_state_dict(checkpoint["model_state_dict"])
 
     # Training loop
-    train(train_dataloader, val_dataloader, model, logger = logger, n_epochs = train_settings["epochs"], optimizer = train_settings["optimizer"], criterion = train_settings["loss_function"], label_smoothing = train_settings["label_smoothing"], use_gradient_clipping = train_settings["use_gradient_clipping"], checkpoint = checkpoint)
+    train(train_dataloader, val_dataloader, model, logger = logger, n_epochs = train_settings["epochs"], optimizer = train_settings["optimizer"], criterion = train_settings["loss_function"], label_smoothing = train_settings["label_smoothing"], use_gradient_clipping = train_settings["use_gradient_clipping"], checkpoint = checkpoint, metric_every = train_settings["metric_every"], async_metrics = train_settings["async_metrics"], precision = train_settings["precision"], accumulation_steps = train_settings["accumulation_steps"], loss_chunk_size = train_settings["loss_chunk_size"] if isinstance(train_settings["loss_chunk_size"], int) else None)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
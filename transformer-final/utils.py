@@ -1,8 +1,11 @@
+import math
+import queue
+import threading
 import torch
 import yaml
 import argparse
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
-from nltk.translate.nist_score import sentence_nist
+from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction, brevity_penalty
+from nltk.translate.nist_score import sentence_nist, nist_length_penalty
 
 device = torch.device("cpu")
 if torch.cuda.is_available():
@@ -66,4 +69,204 @@ def calculate_nist(decoder_outputs, target_tensor, n = 4):
 
     # Average NIST scores across all sequences
     avg_nist_score = sum(nist_scores) / len(nist_scores)
-    return avg_nist_score
\ No newline at end of file
+    return avg_nist_score
+
+class NgramCounts:
+    # Counts of hashed n-grams (with the hash of their prefix), added a batch at a time and only merged into unique
+    # keys once the pending ones outnumber the merged ones, so merging stays rare as the counts grow. A merge syncs
+    # with the host on a GPU, as torch.unique and the boolean mask size their outputs from the data
+    def __init__(self, merge_size = 1 << 20):
+        self.merge_size = merge_size
+        self.keys, self.counts, self.prefixes = [], [], []
+        self.merged_size = 0
+        self.pending_size = 0
+
+    def add(self, keys, counts, prefixes = None):
+        self.keys.append(keys.reshape(-1))
+        self.counts.append(counts.reshape(-1))
+        self.prefixes.append(keys.reshape(-1) if prefixes is None else prefixes.reshape(-1))
+        self.pending_size += keys.numel()
+        if self.pending_size > max(self.merge_size, self.merged_size):
+            self.merge()
+
+    def merge(self):
+        # Returns the unique keys (sorted), their counts and their prefixes
+        if len(self.keys) == 0:
+            return torch.zeros(0, dtype = torch.long), torch.zeros(0, dtype = torch.long), torch.zeros(0, dtype = torch.long)
+        keys, counts, prefixes = torch.cat(self.keys), torch.cat(self.counts), torch.cat(self.prefixes)
+        keep = counts > 0
+        keys, counts, prefixes = keys[keep], counts[keep], prefixes[keep]
+        keys, inverse = torch.unique(keys, return_inverse = True)
+        counts = torch.zeros_like(keys).scatter_add_(0, inverse, counts)
+        prefixes = torch.zeros_like(keys).scatter_(0, inverse, prefixes)
+
+        self.keys, self.counts, self.prefixes = [keys], [counts], [prefixes]
+        self.merged_size = len(keys)
+        self.pending_size = 0
+        return keys, counts, prefixes
+
+class CorpusMetrics:
+    # Corpus-level BLEU (NLTK's corpus_bleu with smoothing method1) and NIST (NLTK's corpus_nist) of the predicted token
+    # ids against the target ids, both cut at their first EOS, accumulated a batch at a time with update().
+    # Each n-gram is hashed to one int64 and the n-grams of every prediction are matched against those of its target
+    # by sorting and binary search, so a batch is scored with a fixed set of tensor operations on its own device,
+    # without copying any scores to the CPU until bleu() or nist() are called. NIST weighs each match by how rare the
+    # n-gram is over all the targets, so the target n-gram counts and the matched n-grams are kept until the end.
+    # Merging them (see NgramCounts) is the only host sync in update(), and only happens once the pending n-grams
+    # outnumber both a million and the merged ones, so the syncs are occasional and spread across batches.
+    HASH_MULTIPLIER = -7046029254386353131  # 0x9E3779B97F4A7C15 as a signed int64, products wrap around
+    PADDING = torch.iinfo(torch.int64).max  # Keys of the positions past the end, which never match
+
+    def __init__(self, max_n = 4, EOS_token = 1):
+        self.max_n = max_n
+        self.EOS_token = EOS_token
+        self.device = None
+
+    def start(self, device):
+        self.device = device
+        self.matches = torch.zeros(self.max_n, dtype = torch.long, device = device)
+        self.bleu_denominators = torch.zeros(self.max_n, dtype = torch.long, device = device)  # At least 1 per sentence
+        self.nist_denominators = torch.zeros(self.max_n, dtype = torch.long, device = device)
+        self.hyp_length = torch.zeros((), dtype = torch.long, device = device)
+        self.ref_length = torch.zeros((), dtype = torch.long, device = device)
+        self.references = [NgramCounts() for _ in range(self.max_n)]
+        self.matched = [NgramCounts() for _ in range(self.max_n)]
+
+    def lengths(self, tokens):
+        # Number of tokens before the first EOS, or all of them
+        eos = tokens == self.EOS_token
+        return torch.where(eos.any(dim = 1), eos.int().argmax(dim = 1), tokens.size(1))
+
+    def hash_ngrams(self, tokens, hashes, n):
+        # Hashes of the n-grams starting at each position, from those of the (n - 1)-grams
+        if n == 1:
+            return tokens + 1
+        return hashes[:, :-1] * self.HASH_MULTIPLIER + tokens[:, n - 1:] + 1
+
+    def keys(self, hashes, lengths, n, padding):
+        positions = torch.arange(hashes.size(1), device = hashes.device)
+        return torch.where(positions + n <= lengths.unsqueeze(1), hashes, padding)
+
+    def update(self, decoder_outputs, target_tensor):
+        # decoder_outputs are the scores (batch_size x seq_len x vocab_size) or the predicted ids (batch_size x seq_len)
+        predicted = decoder_outputs.argmax(dim = -1) if decoder_outputs.dim() == 3 else decoder_outputs
+        predicted, target = predicted.long(), target_tensor.long()
+        if self.device is None:
+            self.start(target.device)
+
+        hyp_lengths, ref_lengths = self.lengths(predicted), self.lengths(target)
+        self.hyp_length += hyp_lengths.sum()
+        self.ref_length += ref_lengths.sum()
+
+        hyp_hashes, ref_hashes = None, None
+        for n in range(1, self.max_n + 1):
+            hyp_prefixes = hyp_hashes
+            hyp_hashes = self.hash_ngrams(predicted, hyp_hashes, n)
+            ref_hashes = self.hash_ngrams(target, ref_hashes, n)
+            self.bleu_denominators[n - 1] += (hyp_lengths - n + 1).clamp(min = 1).sum()
+            self.nist_denominators[n - 1] += (hyp_lengths - n + 1).clamp(min = 0).sum()
+            if ref_hashes.size(1) == 0:
+                continue
+
+            # Padding differs between the prediction and the target, so it never matches
+            ref_keys = self.keys(ref_hashes, ref_lengths, n, self.PADDING - 1).sort(dim = 1).values
+            self.references[n - 1].add(ref_keys, (ref_keys != self.PADDING - 1).long())
+            if hyp_hashes.size(1) == 0:
+                continue
+            hyp_keys, order = self.keys(hyp_hashes, hyp_lengths, n, self.PADDING).sort(dim = 1)
+
+            # The k-th occurrence of an n-gram in the prediction matches if the target has it more than k times (clipping)
+            ref_count = torch.searchsorted(ref_keys, hyp_keys, right = True) - torch.searchsorted(ref_keys, hyp_keys)
+            occurrence = torch.arange(hyp_keys.size(1), device = self.device) - torch.searchsorted(hyp_keys, hyp_keys)
+            matched = occurrence < ref_count
+            self.matches[n - 1] += matched.sum()
+            self.matched[n - 1].add(hyp_keys, matched.long(), None if n == 1 else hyp_prefixes[:, :-1].gather(1, order))
+
+    def bleu(self):
+        if self.device is None or self.matches[0] == 0:
+            return 0
+        # Smoothing method1 adds epsilon = 0.1 to the precisions without any match
+        precisions = [(matches if matches > 0 else 0.1) / denominator for matches, denominator in zip(self.matches.tolist(), self.bleu_denominators.tolist())]
+        return brevity_penalty(self.ref_length.item(), self.hyp_length.item()) * math.exp(math.fsum(math.log(precision) / self.max_n for precision in precisions))
+
+    def nist(self):
+        if self.device is None or self.hyp_length == 0:
+            return 0
+        # Information weight of an n-gram: log2(count of its (n - 1)-gram prefix / count of the n-gram) over the targets,
+        # with the number of target words in place of the prefix count for unigrams
+        references = [counts.merge() for counts in self.references]
+        score = 0
+        for n in range(1, self.max_n + 1):
+            keys, counts, prefixes = self.matched[n - 1].merge()
+            if len(keys) == 0 or self.nist_denominators[n - 1] == 0:
+                continue
+            ref_keys, ref_counts, _ = references[n - 1]
+            ngram_counts = ref_counts[torch.searchsorted(ref_keys, keys)].double()
+            if n == 1:
+                prefix_counts = self.ref_length.double()
+            else:
+                prefix_keys, prefix_ref_counts, _ = references[n - 2]
+                prefix_counts = prefix_ref_counts[torch.searchsorted(prefix_keys, prefixes)].double()
+            score += (counts * torch.log2(prefix_counts / ngram_counts)).sum().item() / self.nist_denominators[n - 1].item()
+        return score * nist_length_penalty(self.ref_length.item(), self.hyp_length.item())
+
+class AsyncMetrics:
+    # CorpusMetrics computed in a background thread. update() only launches the argmax on the device and queues the
+    # predicted ids, the thread copies them to the CPU (so it, not the training loop, waits for the device) and
+    # updates the scores. bleu() and nist() wait for the queued batches. At most max_pending batches are queued, after
+    # which update() waits for the thread, so the predictions held on the device stay bounded.
+    def __init__(self, max_pending = 16, **kwargs):
+        self.metrics = CorpusMetrics(**kwargs)
+        self.queue = queue.Queue(maxsize = max_pending)
+        self.error = None
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is None:
+                try:
+                    predicted, target_tensor = batch
+                    self.metrics.update(predicted.to("cpu"), target_tensor.to("cpu"))
+                except Exception as error:
+                    self.error = error
+
+    def update(self, decoder_outputs, target_tensor):
+        predicted = decoder_outputs.detach().argmax(dim = -1) if decoder_outputs.dim() == 3 else decoder_outputs.detach()
+        self.queue.put((predicted, target_tensor))
+
+    def finish(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def bleu(self):
+        self.finish()
+        return self.metrics.bleu()
+
+    def nist(self):
+        self.finish()
+        return self.metrics.nist()
+
+def make_metrics(async_metrics = False):
+    # Training metrics, computed in a background thread with async_metrics
+    return AsyncMetrics() if async_metrics == True else CorpusMetrics()
+
+# Autocast data types for the precision setting in config.yaml ("fp32" runs without autocast)
+PRECISIONS = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+def autocast(precision = "fp32"):
+    # Runs the forward pass and loss in reduced precision on the training device. The models compute their softmaxes in
+    # float32, so masking and normalisation do not overflow or lose precision in float16
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type = device.type, dtype = dtype if dtype is not None else torch.bfloat16, enabled = dtype is not None)
+
+def grad_scaler(precision = "fp32"):
+    # Small float16 gradients underflow to zero, so the loss is scaled up before the backward pass. bfloat16 has the
+    # exponent range of float32 and needs no scaling, the scaler then passes everything through unchanged
+    return torch.amp.GradScaler(device.type, enabled = precision == "fp16")
\ No newline at end of file